@@ -0,0 +1,212 @@
+# This file is a part of the AnyBlok Multi Engines project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.registry import RegistryException
+from anyblok.config import Configuration
+from itertools import count
+from random import choice, sample, uniform, random, randrange
+from sqlalchemy import event
+from time import perf_counter
+
+
+def get_checkedout(engine):
+    """ Return the number of connections checked out from the engine pool
+
+    Only the ``QueuePool`` knows this number, the other pools return 0
+
+    :param engine: SQLAlchemy engine
+    :rtype: int
+    """
+    pool = engine.pool
+    if hasattr(pool, 'checkedout'):
+        return pool.checkedout()
+
+    return 0
+
+
+class Balancer:
+    """Base class of the balancing strategies, a balancer choose one engine
+    among the read only engines
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def listen(self, engine):
+        """ Called by the registry for each read only engine, to add the
+        events needed by the balancer
+
+        :param engine: read only engine
+        """
+
+    def choice(self, engines):
+        """ Return one engine among the engines
+
+        :param engines: list of the candidate engines, never empty
+        :rtype: engine
+        """
+        raise NotImplementedError
+
+
+class RandomBalancer(Balancer):
+    """Choose randomly the engine, all the engines have the same share"""
+
+    def choice(self, engines):
+        return choice(engines)
+
+
+class WeightedBalancer(Balancer):
+    """Choose randomly the engine in function of the ``weight`` option
+    of the url::
+
+        postgresql://replica1/db?weight=4
+
+    the default weight is 1
+    """
+
+    def choice(self, engines):
+        weights = [self.registry.get_engine_options(engine).get('weight', 1.)
+                   for engine in engines]
+        threshold = uniform(0, sum(weights))
+        for engine, weight in zip(engines, weights):
+            threshold -= weight
+            if threshold <= 0:
+                return engine
+
+        return engines[-1]
+
+
+class RoundRobinBalancer(Balancer):
+    """Choose the engines one after the other"""
+
+    def __init__(self, registry):
+        super(RoundRobinBalancer, self).__init__(registry)
+        self.counter = count()
+
+    def choice(self, engines):
+        return engines[next(self.counter) % len(engines)]
+
+
+class LeastConnectionsBalancer(Balancer):
+    """Choose the engine with the less checked out connections in its pool
+
+    The engines are shuffled before to not always choose the first one
+    when the pools have the same number of checked out connections
+    """
+
+    def choice(self, engines):
+        return min(sample(engines, len(engines)), key=get_checkedout)
+
+
+class PowerOfTwoChoicesBalancer(Balancer):
+    """Choose two engines randomly and keep the one with the less checked
+    out connections in its pool
+    """
+
+    def choice(self, engines):
+        if len(engines) < 2:
+            return engines[0]
+
+        return min(sample(engines, 2), key=get_checkedout)
+
+
+class EWMABalancer(Balancer):
+    """Choose the engine with the lowest exponentially weighted moving
+    average of the duration of its statements
+
+    To spread the load, the fastest engine is compared with another random
+    engine, the score is the average multiplied by the number of checked
+    out connections plus one
+
+    * ``db_ro_ewma_decay``: weight of the last duration in the average
+    * ``db_ro_ewma_exploration``: share of the reads sent to a random
+      engine, to update the average of the slow engines
+
+    The engines without average are chosen first
+    """
+
+    def __init__(self, registry):
+        super(EWMABalancer, self).__init__(registry)
+        self.decay = Configuration.get('db_ro_ewma_decay') or 0.3
+        self.exploration = Configuration.get('db_ro_ewma_exploration') or 0
+        self.latencies = {}
+
+    def listen(self, engine):
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters,
+                                  context, executemany):
+            conn.info['ewma_start'] = perf_counter()
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters,
+                                 context, executemany):
+            start = conn.info.pop('ewma_start', None)
+            if start is not None:
+                self.measured(engine, perf_counter() - start)
+
+    def measured(self, engine, duration):
+        """ Add the duration of one statement to the average of the engine
+
+        :param engine: read only engine
+        :param duration: time in seconds to execute the statement
+        """
+        latency = self.latencies.get(engine)
+        if latency is None:
+            self.latencies[engine] = duration
+        else:
+            self.latencies[engine] = latency + self.decay * (
+                duration - latency)
+
+    def get_score(self, engine):
+        return self.latencies[engine] * (get_checkedout(engine) + 1)
+
+    def choice(self, engines):
+        if len(engines) < 2:
+            return engines[0]
+
+        unknown = [engine for engine in engines
+                   if engine not in self.latencies]
+        if unknown:
+            return choice(unknown)
+
+        if self.exploration and random() < self.exploration:
+            return choice(engines)
+
+        fastest = min(engines, key=self.latencies.__getitem__)
+        other = randrange(len(engines) - 1)
+        if other >= engines.index(fastest):
+            other += 1
+
+        return min((fastest, engines[other]), key=self.get_score)
+
+
+BALANCERS = {
+    'random': RandomBalancer,
+    'weighted': WeightedBalancer,
+    'round-robin': RoundRobinBalancer,
+    'least-connections': LeastConnectionsBalancer,
+    'power-of-two-choices': PowerOfTwoChoicesBalancer,
+    'ewma': EWMABalancer,
+}
+
+
+def get_balancer(name):
+    """ Return the balancer class
+
+    :param name: name of the balancer in ``BALANCERS`` or a Balancer class
+    :rtype: Balancer class
+    :exception: RegistryException
+    """
+    if not isinstance(name, str):
+        return name
+
+    if name not in BALANCERS:
+        raise RegistryException(
+            "Unknown balancer %r, the available balancers are %r" % (
+                name, sorted(BALANCERS)))
+
+    return BALANCERS[name]
@@ -0,0 +1,148 @@
+# This file is a part of the AnyBlok Multi Engines project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from collections import defaultdict, deque
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from threading import Lock
+from time import monotonic
+from logging import getLogger
+
+
+logger = getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker:
+    """Circuit breaker by engine
+
+    * closed: the engine receives the queries, the breaker opens after
+      ``errors`` errors in ``window`` seconds
+    * open: the engine does not receive any query during ``cooldown``
+      seconds
+    * half-open: after the cool-down the engine receives one probe query,
+      the other queries are refused until its answer, a success closes the
+      breaker and an error opens it again. A probe without answer after
+      ``cooldown`` seconds is replaced by another one
+
+    The errors and the successes are given by the events of the engines,
+    see ``listen``
+    """
+
+    def __init__(self, errors, window, cooldown, clock=monotonic):
+        self.errors = errors
+        self.window = window
+        self.cooldown = cooldown
+        self.clock = clock
+        self.lock = Lock()
+        self.failures = defaultdict(deque)
+        self.opened = {}
+        self.probes = {}
+
+    def get_state(self, engine):
+        """Return the state of the breaker of the engine
+
+        :rtype: ``closed``, ``open`` or ``half-open``
+        """
+        opened_at = self.opened.get(engine)
+        if opened_at is None:
+            return CLOSED
+
+        if self.clock() - opened_at < self.cooldown:
+            return OPEN
+
+        return HALF_OPEN
+
+    def is_probing(self, engine):
+        """Return True if the probe of the half-open breaker is running"""
+        probe = self.probes.get(engine)
+        return probe is not None and self.clock() - probe < self.cooldown
+
+    def is_allowed(self, engine):
+        """Return False if the engine must not receive queries"""
+        state = self.get_state(engine)
+        if state == HALF_OPEN:
+            return not self.is_probing(engine)
+
+        return state == CLOSED
+
+    def admit(self, engine):
+        """Return False if the engine must not receive the query, called
+        for the engine chosen by the balancer. The first query admitted by
+        a half-open breaker is its probe
+        """
+        if engine not in self.opened:
+            return True
+
+        with self.lock:
+            if not self.is_allowed(engine):
+                return False
+
+            if self.get_state(engine) == HALF_OPEN:
+                self.probes[engine] = self.clock()
+
+            return True
+
+    def failure(self, engine):
+        """Count one error of the engine"""
+        with self.lock:
+            state = self.get_state(engine)
+            if state == OPEN:
+                # the queries started before the opening
+                return
+
+            now = self.clock()
+            if state == HALF_OPEN:
+                logger.warning('The probe failed, open the circuit breaker '
+                               'of the engine %r again', engine)
+                self.opened[engine] = now
+                self.probes.pop(engine, None)
+                return
+
+            failures = self.failures[engine]
+            failures.append(now)
+            while failures[0] < now - self.window:
+                failures.popleft()
+
+            if len(failures) >= self.errors:
+                logger.warning('Open the circuit breaker of the engine %r '
+                               'after %d errors', engine, len(failures))
+                failures.clear()
+                self.opened[engine] = now
+
+    def success(self, engine):
+        """Close the half-open breaker of the engine"""
+        if engine not in self.opened:
+            return
+
+        with self.lock:
+            if self.get_state(engine) == HALF_OPEN:
+                logger.info('Close the circuit breaker of the engine %r',
+                            engine)
+                del self.opened[engine]
+                self.probes.pop(engine, None)
+
+    def listen(self, engine):
+        """Count the errors and the successes of the engine with the
+        ``handle_error`` and ``after_cursor_execute`` events, only the
+        OperationalError (disconnection, timeout, ...) are errors
+        """
+        @event.listens_for(engine, 'handle_error')
+        def handle_error(context):
+            if (
+                context.is_disconnect or
+                isinstance(context.sqlalchemy_exception, OperationalError)
+            ):
+                self.failure(engine)
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters,
+                                 context, executemany):
+            self.success(engine)
@@ -0,0 +1,137 @@
+# This file is a part of the AnyBlok Multi Engines project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class QueryCache:
+    """LRU cache of the query results, with a time to live
+
+    Each entry knows the tables read by its query, ``invalidate`` removes
+    the entries of the written tables. The cache is shared by the sessions
+    of the registry, in one process
+
+    A result is not saved if one of its tables was invalidated since the
+    ``snapshot`` taken before the query, or during the ``grace`` seconds
+    after the invalidation, the time for the replicas to replay the write
+    """
+
+    def __init__(self, size, ttl, grace=0, clock=monotonic):
+        self.size = size
+        self.ttl = ttl
+        self.grace = grace
+        self.clock = clock
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.keys_by_table = {}
+        self.invalidations = {}
+        self.generation = 0
+        self.hits = self.misses = 0
+
+    def snapshot(self):
+        """ Return the number of invalidations, to give to ``set``
+
+        :rtype: int
+        """
+        return self.generation
+
+    def is_invalidated(self, tables, since):
+        """ Return True if one of the tables was invalidated since the
+        snapshot or during the grace period, the lock must be acquired
+        """
+        now = self.clock()
+        for table in tables:
+            invalidation = self.invalidations.get(table)
+            if invalidation is None:
+                continue
+
+            generation, invalidated_at = invalidation
+            if since is not None and generation > since:
+                return True
+
+            if now - invalidated_at < self.grace:
+                return True
+
+        return False
+
+    def get(self, key):
+        """ Return the value of the key, or None if the key is missing or
+        expired
+
+        :param key: hashable key
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires, tables, value = entry
+            if expires < self.clock():
+                self.remove(key)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, tables, value, ttl=None, since=None):
+        """ Save the value, the least recently used entry is removed if the
+        cache is full
+
+        :param key: hashable key
+        :param tables: names of the tables read to get the value
+        :param value: value to save
+        :param ttl: time to live in seconds, by default the ttl of the cache
+        :param since: ``snapshot`` taken before the read of the value
+        """
+        expires = self.clock() + (ttl or self.ttl)
+        with self.lock:
+            if self.is_invalidated(tables, since):
+                return
+
+            if key in self.entries:
+                self.remove(key)
+
+            self.entries[key] = (expires, tables, value)
+            for table in tables:
+                self.keys_by_table.setdefault(table, set()).add(key)
+
+            while len(self.entries) > self.size:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        """ Remove the entry, the lock must be acquired """
+        expires, tables, value = self.entries.pop(key)
+        for table in tables:
+            keys = self.keys_by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_by_table[table]
+
+    def invalidate(self, tables):
+        """ Remove the entries which read one of the tables
+
+        :param tables: names of the written tables
+        """
+        with self.lock:
+            self.generation += 1
+            now = self.clock()
+            for table in tables:
+                self.invalidations[table] = (self.generation, now)
+                for key in list(self.keys_by_table.get(table, ())):
+                    self.remove(key)
+
+    def clear(self):
+        """ Remove all the entries """
+        with self.lock:
+            self.entries.clear()
+            self.keys_by_table.clear()
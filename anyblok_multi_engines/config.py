@@ -5,29 +5,65 @@
 # This Source Code Form is subject to the terms of the Mozilla Public License,
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
-from anyblok.config import Configuration, ConfigurationException
+from anyblok.config import (
+    Configuration, ConfigurationException, AnyBlokPlugin)
 from sqlalchemy.engine.url import URL, make_url
+from .balancer import BALANCERS
+from functools import lru_cache
 import os
 
 
+POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_recycle')
+
+URL_OPTIONS = {
+    'weight': float,
+    'name': str,
+    'zone': str,
+    'pool_size': int,
+    'max_overflow': int,
+    'pool_recycle': int,
+}
+
+
 def get_url(db_name=None, url=None):
     """ Return an sqlalchemy URL for database
 
+    The urls are built once by ``build_url`` for the same values of the
+    Configuration, a copy is returned because the SQLAlchemy URL is mutable
+
     :param db_name: Name of the database
     :param url: base of the url
     :rtype: SqlAlchemy URL
     :exception: ConfigurationException
     """
-    drivername = Configuration.get('db_driver_name', None)
-    username = Configuration.get('db_user_name', None)
-    password = Configuration.get('db_password', None)
-    host = Configuration.get('db_host', None)
-    port = Configuration.get('db_port', None)
     database = Configuration.get('db_name', None)
-
     if db_name is not None:
         database = db_name
 
+    return copy_url(build_url(
+        Configuration.get('db_driver_name', None),
+        Configuration.get('db_user_name', None),
+        Configuration.get('db_password', None),
+        Configuration.get('db_host', None),
+        Configuration.get('db_port', None),
+        database, url))
+
+
+@lru_cache(maxsize=1024)
+def build_url(drivername, username, password, host, port, database, url):
+    """ Return an sqlalchemy URL for database, the result is cached because
+    the values of the Configuration are a part of the key of the cache
+
+    :param drivername: ``db_driver_name`` option
+    :param username: ``db_user_name`` option
+    :param password: ``db_password`` option
+    :param host: ``db_host`` option
+    :param port: ``db_port`` option
+    :param database: name of the database
+    :param url: base of the url
+    :rtype: SqlAlchemy URL
+    :exception: ConfigurationException
+    """
     if url:
         url = make_url(url)
         if username:
@@ -46,6 +82,77 @@ def get_url(db_name=None, url=None):
                port=port, database=database)
 
 
+def copy_url(url):
+    """ Return a copy of the sqlalchemy URL
+
+    :param url: SqlAlchemy URL
+    :rtype: SqlAlchemy URL
+    """
+    return URL(url.drivername, username=url.username, password=url.password,
+               host=url.host, port=url.port, database=url.database,
+               query=dict(url.query))
+
+
+def get_url_options(url):
+    """ Split the url and the AnyBlok Multi Engines options
+
+    the options are given in the query string of the url and are removed
+    from it because they are not know by the DBAPI::
+
+        postgresql://replica1/db?weight=4&name=reporting&pool_size=20
+
+    :param url: complete url
+    :rtype: tuple(str url without the options, dict of the options)
+    """
+    url = make_url(url)
+    options = {}
+    for key, cast in URL_OPTIONS.items():
+        if key in url.query:
+            options[key] = cast(url.query.pop(key))
+
+    return str(url), options
+
+
+def get_mapping(values):
+    """ Split the ``key=value`` values of a Configuration option
+
+    only the first ``=`` is used, the value can contain others ``=``::
+
+        get_mapping(['group1=postgresql://host/db?weight=2'])
+        => [('group1', 'postgresql://host/db?weight=2')]
+
+    :param values: list of ``key=value``, or None
+    :rtype: list of (key, value)
+    :exception: ConfigurationException
+    """
+    mapping = []
+    for value in values or []:
+        if '=' not in value:
+            raise ConfigurationException(
+                "Waiting 'key=value' and not %r" % value)
+
+        key, value = value.split('=', 1)
+        mapping.append((key.strip(), value.strip()))
+
+    return mapping
+
+
+def get_statements(value):
+    """ Split the SQL statements of a Configuration option, one statement
+    by line, the spaces and the commas are a part of the statement::
+
+        get_statements('PREPARE a AS SELECT 1\nPREPARE b AS SELECT 2')
+        => ['PREPARE a AS SELECT 1', 'PREPARE b AS SELECT 2']
+
+    :param value: statements separated by new lines, or list of statements
+    :rtype: list of str
+    """
+    if isinstance(value, str):
+        value = value.split('\n')
+
+    return [statement.strip() for statement in value if statement.strip()]
+
+
 @Configuration.add('database')
 def update_database(group):
     group.add_argument('--db-ro-urls',
@@ -58,6 +165,230 @@ def update_database(group):
                        help="Complete URL for write only connection with "
                             "the database, you can't use bothg --db-wo-url "
                             "and --db-url")
+    for role, label in (('ro', 'read only'), ('wo', 'write')):
+        group.add_argument('--db-%s-pool-size' % role, type=int,
+                           default=os.environ.get(
+                               'ANYBLOK_DATABASE_%s_POOL_SIZE' % role.upper()),
+                           help="Pool size of the %s engines, by default "
+                                "--db-pool-size" % label)
+        group.add_argument('--db-%s-max-overflow' % role, type=int,
+                           default=os.environ.get(
+                               'ANYBLOK_DATABASE_%s_MAX_OVERFLOW' % (
+                                   role.upper())),
+                           help="Max overflow of the pool of the %s engines, "
+                                "by default --db-max-overflow" % label)
+        group.add_argument('--db-%s-pool-recycle' % role, type=int,
+                           default=os.environ.get(
+                               'ANYBLOK_DATABASE_%s_POOL_RECYCLE' % (
+                                   role.upper())),
+                           help="Time in seconds after which the connections "
+                                "of the %s engines are recycled" % label)
+
+    group.add_argument('--db-group-wo-urls', nargs='+',
+                       default=os.environ.get('ANYBLOK_DATABASE_GROUP_URLS_WO'),
+                       help="Master url of the engine groups, written "
+                            "group=url, one master by group")
+    group.add_argument('--db-group-ro-urls', nargs='+',
+                       default=os.environ.get('ANYBLOK_DATABASE_GROUP_URLS_RO'),
+                       help="Read only url(s) of the engine groups, written "
+                            "group=url")
+    group.add_argument('--db-group-models', nargs='+',
+                       default=os.environ.get('ANYBLOK_DATABASE_GROUP_MODELS'),
+                       help="Engine group of the models, written "
+                            "Model.Name=group, overwrite the __engine_group__ "
+                            "attribute of the models, the other models use "
+                            "the db_group key of the environment")
+    group.add_argument('--db-exists-timeout', type=float,
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_EXISTS_TIMEOUT'),
+                       help="Max time in seconds to check in parallel that "
+                            "the database exists on all the engines")
+    group.add_argument('--db-fanout-timeout', type=float,
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_FANOUT_TIMEOUT'),
+                       help="Max time in seconds to wait the answers of the "
+                            "engines for registry.fanout")
+    group.add_argument('--db-read-only', action='store_true',
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_READ_ONLY', False),
+                       help="Read only registry: no master, no migration, "
+                            "no flush and read only transactions. Without "
+                            "--db-ro-urls the url of the master is used as "
+                            "read only engine")
+    group.add_argument('--db-share-engines', action='store_true',
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_SHARE_ENGINES', False),
+                       help="Share the pools of the engines between the "
+                            "registries of the process with the same url, "
+                            "the database can be different for MySQL")
+    group.add_argument('--db-query-cache-size', type=int,
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_QUERY_CACHE_SIZE', 0),
+                       help="Number of query results saved in the cache of "
+                            "the queries marked with cached(), 0 = disabled")
+    group.add_argument('--db-query-cache-ttl', type=float,
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_QUERY_CACHE_TTL', 60),
+                       help="Time to live in seconds of the query results "
+                            "in the cache, the writes of the other processes "
+                            "are seen after this time")
+    group.add_argument('--db-prewarm-connections', type=int,
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_PREWARM_CONNECTIONS', 0),
+                       help="Number of connections opened by engine at the "
+                            "load of the registry, limited by the size of the "
+                            "pool, 0 = disabled")
+    group.add_argument('--db-prewarm-sql', type=get_statements,
+                       default=os.environ.get('ANYBLOK_DATABASE_PREWARM_SQL'),
+                       help="Statements executed on each prewarmed "
+                            "connection, one statement by line, for example "
+                            "PREPARE statements")
+    group.add_argument('--db-prewarm-timeout', type=float,
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_PREWARM_TIMEOUT', 10),
+                       help="Max time in seconds to wait the prewarmed "
+                            "connections")
+    group.add_argument('--db-bulk-pool-size', type=int,
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_BULK_POOL_SIZE', 1),
+                       help="Pool size of the bulk engines, used by "
+                            "registry.bulk_write")
+    group.add_argument('--db-bulk-page-size', type=int,
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_BULK_PAGE_SIZE', 1000),
+                       help="Number of rows by INSERT ... VALUES for the "
+                            "executemany of the bulk engines (psycopg2)")
+    group.add_argument('--db-bulk-statement-timeout', type=float,
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_BULK_STATEMENT_TIMEOUT'),
+                       help="statement_timeout in seconds of the bulk "
+                            "engines, 0 = no timeout (PostgreSQL)")
+    group.add_argument('--db-bulk-synchronous-commit',
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_BULK_SYNCHRONOUS_COMMIT'),
+                       choices=['on', 'off', 'local', 'remote_write',
+                                'remote_apply'],
+                       help="synchronous_commit of the bulk engines, off is "
+                            "faster but the last commits can be lost by a "
+                            "crash of the server (PostgreSQL)")
+    group.add_argument('--db-zone',
+                       default=os.environ.get('ANYBLOK_DATABASE_ZONE'),
+                       help="Zone of the worker, the read only engines with "
+                            "the same zone option in their url are preferred "
+                            "while one of them is available")
+    group.add_argument('--db-ro-balancer',
+                       default=os.environ.get('ANYBLOK_DATABASE_RO_BALANCER',
+                                              'random'),
+                       choices=sorted(BALANCERS),
+                       help="Strategy to choose the read only engine: "
+                            "random, weighted (weight option in the url), "
+                            "round-robin, least-connections, "
+                            "power-of-two-choices or ewma (lowest average "
+                            "latency)")
+    group.add_argument('--db-ro-ewma-decay', type=float,
+                       default=os.environ.get('ANYBLOK_DATABASE_RO_EWMA_DECAY',
+                                              0.3),
+                       help="Weight of the last statement in the average "
+                            "latency of the ewma balancer, between 0 and 1")
+    group.add_argument('--db-ro-ewma-exploration', type=float,
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_RO_EWMA_EXPLORATION', 0.05),
+                       help="Share of the reads sent to a random engine by "
+                            "the ewma balancer, to measure the slow engines")
+    group.add_argument('--db-ro-health-check-interval', type=float,
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_RO_HEALTH_CHECK_INTERVAL', 0),
+                       help="Interval in seconds between two health checks "
+                            "of the read only engines, 0 disables the "
+                            "health checks")
+    group.add_argument('--db-ro-health-check-timeout', type=float,
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_RO_HEALTH_CHECK_TIMEOUT', 1),
+                       help="Timeout in seconds of the health and lag "
+                            "checks")
+    group.add_argument('--db-ro-health-check-rise', type=int,
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_RO_HEALTH_CHECK_RISE', 2),
+                       help="Number of consecutive successful health checks "
+                            "to reinstate an ejected engine")
+    group.add_argument('--db-ro-breaker-errors', type=int,
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_RO_BREAKER_ERRORS', 0),
+                       help="Number of errors in --db-ro-breaker-window "
+                            "seconds which open the circuit breaker of a "
+                            "read only engine, 0 = disabled")
+    group.add_argument('--db-ro-breaker-window', type=float,
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_RO_BREAKER_WINDOW', 10),
+                       help="Time window in seconds to count the errors")
+    group.add_argument('--db-ro-breaker-cooldown', type=float,
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_RO_BREAKER_COOLDOWN', 30),
+                       help="Time in seconds without query on an engine with "
+                            "an open circuit breaker, before the probe "
+                            "queries")
+    group.add_argument('--db-ro-max-lag', type=float,
+                       default=os.environ.get('ANYBLOK_DATABASE_RO_MAX_LAG',
+                                              0),
+                       help="Max replication lag in seconds of a read only "
+                            "engine to receive queries, 0 disables the lag "
+                            "checks")
+    group.add_argument('--db-ro-lag-check-interval', type=float,
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_RO_LAG_CHECK_INTERVAL', 5),
+                       help="Interval in seconds between two replication "
+                            "lag checks of the read only engines")
+    group.add_argument('--db-sticky-after-write', action='store_true',
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_STICKY_AFTER_WRITE', False),
+                       help="After a write, the session reads on the master "
+                            "until the end of the transaction")
+    group.add_argument('--db-sticky-window', type=float,
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_STICKY_WINDOW', 0),
+                       help="Time in seconds after the commit of a write "
+                            "during which the reads of the same environment "
+                            "stay on the master, need --db-sticky-after-write")
+    group.add_argument('--db-read-your-writes', action='store_true',
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_READ_YOUR_WRITES', False),
+                       help="Save the WAL position of the master at the "
+                            "commit of a write, the next reads of the same "
+                            "environment use only the replicas which replayed "
+                            "this position (PostgreSQL)")
+    group.add_argument('--db-ro-lsn-wait', type=float,
+                       default=os.environ.get('ANYBLOK_DATABASE_RO_LSN_WAIT',
+                                              0.1),
+                       help="Max time in seconds to wait for a replica which "
+                            "replayed the position of the last write, before "
+                            "to read on the master")
+    group.add_argument('--db-ro-session-affinity', action='store_true',
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_RO_SESSION_AFFINITY', False),
+                       help="The session keeps the read only engine of its "
+                            "first read until the end of the transaction")
+    group.add_argument('--db-ro-retries', type=int,
+                       default=os.environ.get('ANYBLOK_DATABASE_RO_RETRIES',
+                                              0),
+                       help="Number of retries of a read query on another "
+                            "engine after an OperationalError, only if the "
+                            "transaction did nothing before, 0 = disabled")
+    group.add_argument('--db-ro-retry-backoff', type=float,
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_RO_RETRY_BACKOFF', 0.05),
+                       help="Time in seconds waited before the first retry, "
+                            "doubled at each retry")
+    group.add_argument('--db-metrics', action='store_true',
+                       default=os.environ.get('ANYBLOK_DATABASE_METRICS',
+                                              False),
+                       help="Count the routing decisions and the time waited "
+                            "to get a connection, see registry.metrics")
+    group.add_argument('--db-metrics-callback', type=AnyBlokPlugin,
+                       default=os.environ.get(
+                           'ANYBLOK_DATABASE_METRICS_CALLBACK'),
+                       help="Function called for each routing decision with "
+                            "the engine name, the role and the duration, "
+                            "ex: my.module:my_function")
 
 
 @Configuration.add('plugins', must_be_loaded_by_unittest=True)
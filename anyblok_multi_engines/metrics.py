@@ -0,0 +1,168 @@
+# This file is a part of the AnyBlok Multi Engines project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok_multi_engines.balancer import get_checkedout
+from anyblok_multi_engines.breaker import OPEN
+from collections import defaultdict
+from threading import Lock
+
+
+PREFIX = 'anyblok_multi_engines_'
+
+
+def escape_label(value):
+    """ Escape the value of a label for the text exposition format """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def format_labels(labels):
+    """ Return the labels for the text exposition format
+
+    :param labels: tuple of (name, value)
+    :rtype: str
+    """
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (name, escape_label(value))
+                             for name, value in labels)
+
+
+class Metrics:
+    """Routing and pool metrics of the engines of a registry
+
+    The counters are updated by the session, the states of the pools and of
+    the monitors are read when the metrics are collected. The metrics are
+    exported:
+
+    * in the Prometheus text exposition format by ``exposition``
+    * by the ``callback`` called for each routing decision with
+      ``(engine name, role, duration)``
+    """
+
+    def __init__(self, registry, callback=None):
+        self.registry = registry
+        self.callback = callback
+        self.lock = Lock()
+        self.routed_total = defaultdict(int)
+        self.routing_seconds = [0., 0]
+        self.wait_seconds = defaultdict(lambda: [0., 0])
+
+    def routed(self, engine, role, duration):
+        """ Count one routing decision
+
+        :param engine: engine returned by ``get_bind``
+        :param role: ``ro`` for a read, ``wo`` for a write
+        :param duration: time in seconds to choose the engine
+        """
+        name = self.registry.get_engine_name(engine)
+        with self.lock:
+            self.routed_total[(name, role)] += 1
+            self.routing_seconds[0] += duration
+            self.routing_seconds[1] += 1
+
+        if self.callback:
+            self.callback(name, role, duration)
+
+    def waited(self, engine, duration):
+        """ Add the time waited to get a connection from the engine
+
+        :param engine: engine of the connection
+        :param duration: time in seconds to get the connection
+        """
+        name = self.registry.get_engine_name(engine)
+        with self.lock:
+            wait_seconds = self.wait_seconds[name]
+            wait_seconds[0] += duration
+            wait_seconds[1] += 1
+
+    def collect(self):
+        """ Return the metrics
+
+        :rtype: list of (name, type, list of (suffix, labels, value))
+        """
+        with self.lock:
+            metrics = [
+                ('routed_total', 'counter', [
+                    ('', (('engine', name), ('role', role)), value)
+                    for (name, role), value in self.routed_total.items()]),
+                ('routing_seconds', 'summary', [
+                    ('_sum', (), self.routing_seconds[0]),
+                    ('_count', (), self.routing_seconds[1])]),
+                ('pool_wait_seconds', 'summary', [
+                    (suffix, (('engine', name),), value)
+                    for name, values in self.wait_seconds.items()
+                    for suffix, value in zip(('_sum', '_count'), values)]),
+            ]
+
+        metrics.extend(self.collect_engines())
+        return metrics
+
+    def collect_engines(self):
+        """ Return the metrics of the pools, of the monitors and of the
+        query cache
+        """
+        registry = self.registry
+        engines = [(registry.get_engine_name(engine), engine)
+                   for engine in registry.get_engines()]
+        metrics = [
+            ('pool_checkedout', 'gauge', [
+                ('', (('engine', name),), get_checkedout(engine))
+                for name, engine in engines]),
+            ('pool_overflow', 'gauge', [
+                ('', (('engine', name),), engine.pool.overflow())
+                for name, engine in engines
+                if hasattr(engine.pool, 'overflow')]),
+        ]
+        if registry.health_checker:
+            ro_engines = registry.get_all_ro_engines()
+            metrics.append(('engine_healthy', 'gauge', [
+                ('', (('engine', name),),
+                 int(registry.health_checker.is_healthy(engine)))
+                for name, engine in engines
+                if engine in ro_engines]))
+
+        if registry.circuit_breaker:
+            ro_engines = registry.get_all_ro_engines()
+            metrics.append(('engine_circuit_open', 'gauge', [
+                ('', (('engine', name),),
+                 int(registry.circuit_breaker.get_state(engine) == OPEN))
+                for name, engine in engines
+                if engine in ro_engines]))
+
+        if registry.lag_monitor:
+            lags = registry.lag_monitor.lags
+            metrics.append(('engine_lag_seconds', 'gauge', [
+                ('', (('engine', name),), lags[engine])
+                for name, engine in engines
+                if lags.get(engine) is not None]))
+
+        if registry.query_cache:
+            cache = registry.query_cache
+            metrics.extend([
+                ('query_cache_hits_total', 'counter', [('', (), cache.hits)]),
+                ('query_cache_misses_total', 'counter', [
+                    ('', (), cache.misses)]),
+            ])
+
+        return metrics
+
+    def exposition(self):
+        """ Return the metrics in the Prometheus text exposition format
+
+        :rtype: str
+        """
+        lines = []
+        for name, type_, values in self.collect():
+            name = PREFIX + name
+            lines.append('# TYPE %s %s' % (name, type_))
+            for suffix, labels, value in values:
+                lines.append('%s%s%s %s' % (
+                    name, suffix, format_labels(labels), value))
+
+        return '\n'.join(lines) + '\n'
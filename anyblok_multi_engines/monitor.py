@@ -0,0 +1,252 @@
+# This file is a part of the AnyBlok Multi Engines project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from concurrent.futures import Future, wait
+from threading import Thread, Event
+from anyblok_multi_engines.shared import SHARED_ENGINES
+from sqlalchemy import text
+from logging import getLogger
+
+
+logger = getLogger(__name__)
+
+
+def parse_lsn(lsn):
+    """ Return the PostgreSQL WAL position as an integer
+
+    :param lsn: position written ``16/B374D848``
+    :rtype: int or None
+    """
+    if lsn is None:
+        return None
+
+    high, low = lsn.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def get_current_lsn(engine):
+    """ Return the WAL position of the master, None for the other dialects
+
+    :param engine: master engine
+    :rtype: int or None
+    """
+    if engine.dialect.name != 'postgresql':
+        return None
+
+    with engine.connect() as conn:
+        return parse_lsn(conn.scalar(text('SELECT pg_current_wal_lsn()')))
+
+
+def get_replay_lsn(engine):
+    """ Return the WAL position replayed by the replica, None for the other
+    dialects or if the engine is not a replica
+
+    :param engine: read only engine
+    :rtype: int or None
+    """
+    if engine.dialect.name != 'postgresql':
+        return None
+
+    with engine.connect() as conn:
+        return parse_lsn(conn.scalar(text('SELECT pg_last_wal_replay_lsn()')))
+
+
+def submit_in_thread(name, function, *args):
+    """ Execute the function in its own daemon thread, a thread blocked by
+    a hanging engine neither delays the other calls nor the exit of the
+    process
+
+    :param name: name of the thread
+    :param function: function to call with the args
+    :rtype: Future of the result of the function
+    """
+    future = Future()
+
+    def run():
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(function(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+    Thread(target=run, name=name, daemon=True).start()
+    return future
+
+
+class EngineMonitor(Thread):
+    """Daemon thread which checks periodically the read only engines
+
+    All the engines are checked in parallel, a check which does not
+    answer before the timeout is a failed check. A hanging check is not
+    started again, the engine fails all the checks until the first one
+    ends
+    """
+
+    def __init__(self, registry, interval, timeout):
+        super(EngineMonitor, self).__init__(
+            name='%s(%s)' % (self.__class__.__name__, registry.db_name))
+        self.daemon = True
+        self.registry = registry
+        self.interval = interval
+        self.timeout = timeout
+        self.stopped = Event()
+        self.running = {}
+
+    def get_engines(self):
+        """Return the engines to check"""
+        return self.registry.get_all_ro_engines()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check_engines()
+            except Exception:
+                logger.exception('Error during the check of the engines')
+
+    def stop(self):
+        """Stop the thread, the check in progress are not waited"""
+        self.stopped.set()
+
+    def check_engines(self):
+        """Check all the engines in parallel and wait the results until
+        the timeout
+        """
+        futures = {}
+        for engine in self.get_engines():
+            future = self.running.get(engine)
+            if future is not None and not future.done():
+                self.failed(engine, TimeoutError(
+                    'The previous check is still running'))
+                continue
+
+            future = self.running[engine] = self.submit(engine)
+            futures[future] = engine
+
+        if not futures:
+            return
+
+        wait(futures, timeout=self.timeout)
+        for future, engine in futures.items():
+            if not future.done():
+                self.failed(engine, TimeoutError(
+                    'No answer after %r seconds' % self.timeout))
+            elif future.exception():
+                self.failed(engine, future.exception())
+            else:
+                self.succeeded(engine, future.result())
+
+    def submit(self, engine):
+        """Execute the check of the engine in its own daemon thread
+
+        :param engine: engine to check
+        :rtype: Future
+        """
+        return submit_in_thread('%s(%r)' % (self.name, engine), self.check,
+                                engine)
+
+    def check(self, engine):
+        """Execute the check on the engine, called in a worker thread
+
+        :param engine: engine to check
+        :rtype: result of the check
+        """
+        raise NotImplementedError
+
+    def failed(self, engine, exception):
+        """Called when the check failed or timed out"""
+        raise NotImplementedError
+
+    def succeeded(self, engine, result):
+        """Called with the result of the check"""
+        raise NotImplementedError
+
+
+class HealthChecker(EngineMonitor):
+    """Eject the read only engines which fail to execute ``SELECT 1``
+
+    An ejected engine is reinstated after ``rise`` consecutive successful
+    checks
+    """
+
+    def __init__(self, registry, interval, timeout, rise=1):
+        super(HealthChecker, self).__init__(registry, interval, timeout)
+        self.rise = rise
+        self.unhealthy = set()
+        self.successes = {}
+
+    def is_healthy(self, engine):
+        """Return False if the engine is ejected"""
+        return engine not in self.unhealthy
+
+    def check(self, engine):
+        with engine.connect() as conn:
+            return conn.scalar(text('SELECT 1'))
+
+    def failed(self, engine, exception):
+        self.successes[engine] = 0
+        if engine not in self.unhealthy:
+            logger.warning('Eject the engine %r: %s', engine, exception)
+            self.unhealthy.add(engine)
+            # the connections in the pool are probably dead
+            SHARED_ENGINES.dispose(engine)
+
+    def succeeded(self, engine, result):
+        if engine not in self.unhealthy:
+            return
+
+        self.successes[engine] = self.successes.get(engine, 0) + 1
+        if self.successes[engine] >= self.rise:
+            logger.info('Reinstate the engine %r', engine)
+            self.unhealthy.discard(engine)
+
+
+class LagMonitor(EngineMonitor):
+    """Read the replication lag of the read only engines
+
+    Only PostgreSQL (>= 10) gives its lag, the lag of the other dialects is
+    unknown. A replica which has replayed all the WAL it received has no lag,
+    even if the master did not write since a long time
+    """
+
+    query = text("""
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() THEN 0
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+        END
+    """)
+
+    def __init__(self, registry, interval, timeout, max_lag):
+        super(LagMonitor, self).__init__(registry, interval, timeout)
+        self.max_lag = max_lag
+        self.lags = {}
+
+    def is_lagging(self, engine):
+        """Return True if the lag of the engine is over the max lag"""
+        lag = self.lags.get(engine)
+        return lag is not None and lag > self.max_lag
+
+    def check(self, engine):
+        if engine.dialect.name != 'postgresql':
+            return None
+
+        with engine.connect() as conn:
+            lag = conn.scalar(self.query)
+            return None if lag is None else float(lag)
+
+    def failed(self, engine, exception):
+        logger.debug('Unknown lag for the engine %r: %s', engine, exception)
+        self.lags.pop(engine, None)
+
+    def succeeded(self, engine, result):
+        was_lagging = self.is_lagging(engine)
+        self.lags[engine] = result
+        if was_lagging and not self.is_lagging(engine):
+            logger.info('The engine %r caught up with the master', engine)
+        elif not was_lagging and self.is_lagging(engine):
+            logger.warning('The engine %r is %r seconds behind the master',
+                           engine, result)
@@ -7,39 +7,613 @@
 # obtain one at http://mozilla.org/MPL/2.0/.
 from anyblok.registry import Registry, RegistryException, RegistryManager
 from anyblok.config import Configuration
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.orm import (
+    sessionmaker, scoped_session, object_mapper)
 from anyblok.environment import EnvironmentManager
-from anyblok_multi_engines.config import get_url
-from sqlalchemy import create_engine
+from contextlib import contextmanager
+from concurrent.futures import (
+    wait, as_completed, TimeoutError as FuturesTimeoutError)
+from anyblok_multi_engines.config import (
+    get_url, get_url_options, get_mapping, get_statements, POOL_OPTIONS)
+from anyblok_multi_engines.balancer import get_balancer
+from anyblok_multi_engines.monitor import (
+    HealthChecker, LagMonitor, get_current_lsn, get_replay_lsn,
+    submit_in_thread)
+from anyblok_multi_engines.breaker import CircuitBreaker
+from anyblok_multi_engines.shared import SHARED_ENGINES, execute_on_connect
+from anyblok_multi_engines.cache import QueryCache
+from anyblok_multi_engines.metrics import Metrics
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.exc import OperationalError, InvalidRequestError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.util import find_tables
+from itertools import chain
+from threading import Lock
 from sqlalchemy_utils.functions import database_exists
-from random import choice
 from logging import getLogger
+from time import time, perf_counter, sleep, monotonic
 
 
 logger = getLogger(__name__)
 
+READ_ONLY_TRANSACTION = {
+    'postgresql': ('SET SESSION CHARACTERISTICS AS TRANSACTION READ ONLY '
+                   'DEFERRABLE'),
+    'mysql': 'SET SESSION TRANSACTION READ ONLY',
+}
+"""Statement to mark the transactions of a connection read only, by
+dialect, used by the read only registries
+"""
+
+STATEMENT_TIMEOUT = {
+    'postgresql': 'SET LOCAL statement_timeout = %d',
+}
+"""Statement to limit the duration of the queries of the current
+transaction in milliseconds, by dialect, used by ``fanout``
+"""
+
 
 class MixinSession:
     """Mixin for the SQLAlchemy session the goal is to allow the connection
     with more than one engine: masters / slaves engines
     """
 
+    wrote_on_master = False
+    ro_engines = None
+    routing = None
+    last_ro_engine = None
+    excluded_engines = None
+    written_engines = None
+    last_written_engines = None
+    written_tables = None
+
     def get_bind(self, mapper=None, clause=None):
         """Overload the ``Session.get_bind`` method of SQLAlchemy
 
+        the engine is chosen by ``get_engine``, and the decision is
+        counted when the metrics are enabled
+        """
+        metrics = self.registry.metrics
+        if metrics is None:
+            return self.get_engine(mapper=mapper, clause=clause)
+
+        start = perf_counter()
+        engine = self.get_engine(mapper=mapper, clause=clause)
+        metrics.routed(engine, 'wo' if self.is_writing(clause) else 'ro',
+                       perf_counter() - start)
+        return engine
+
+    def _connection_for_bind(self, engine, execution_options=None, **kw):
+        """Overload to measure the time waited to get a connection, only
+        the first statement of the transaction on the engine checks out a
+        connection
+        """
+        metrics = self.registry.metrics
+        if metrics is None or self.has_connection(engine):
+            return super(MixinSession, self)._connection_for_bind(
+                engine, execution_options=execution_options, **kw)
+
+        start = perf_counter()
+        try:
+            return super(MixinSession, self)._connection_for_bind(
+                engine, execution_options=execution_options, **kw)
+        finally:
+            metrics.waited(engine, perf_counter() - start)
+
+    def has_connection(self, engine):
+        """Return True if the transaction, or one of its parents, has
+        already a connection of the engine
+        """
+        transaction = self.transaction
+        while transaction is not None:
+            if engine in transaction._connections:
+                return True
+
+            transaction = transaction._parent
+
+        return False
+
+    def is_writing(self, clause=None):
+        """Return True if the session flushes or if the clause is a DML
+        statement, the writes are executed on the master
+        """
+        return self._flushing or isinstance(clause, UpdateBase)
+
+    def get_engine(self, mapper=None, clause=None):
+        """Return the engine to use
+
         the rule are:
 
         * if unittest_transaction: durring unittest, they are no
           slaves / masters
-        * if flushing: write on the database then we use the master
+        * the engine group is chosen by the model of the mapper or by
+          the environment
+        * if flushing or DML statement: write on the database then we use
+          the master, forbidden for a read only registry
+        * if routing: the engine is forced by ``using``
+        * if sticky after write: read the master after a write
         * read the database then use a slave
         """
         if self.registry.unittest_transaction:
             return self.registry.bind
-        elif self._flushing:
-            return self.registry.get_engine_for(ro=False)
+
+        group = self.registry.get_engine_group(mapper)
+        if self.is_writing(clause):
+            if self.registry.read_only:
+                raise RegistryException(
+                    "The registry is read only, no write is allowed")
+
+            self.wrote_on_master = True
+            engine = self.registry.get_engine_for(ro=False, group=group)
+            if self.registry.read_your_writes:
+                if self.written_engines is None:
+                    self.written_engines = set()
+
+                self.written_engines.add(engine)
+
+            if self.routing == 'bulk':
+                return self.registry.get_bulk_engine(group=group)
+
+            return engine
+        elif self.routing:
+            return self.get_engine_for_routing(group=group)
+        elif self.must_read_on_master():
+            return self.registry.get_engine_for(ro=False, group=group)
+        else:
+            return self.get_ro_engine(group=group)
+
+    def get_ro_engine(self, group=None):
+        """Return the read only engine, with the session affinity the
+        engine chosen by the first read is kept until the end of the
+        transaction, if it is still available
+
+        :param group: name of the engine group, None for the default engines
+        :rtype: engine
+        """
+        exclude = self.excluded_engines
+        if not self.registry.session_affinity:
+            engine = self.registry.get_engine_for(group=group,
+                                                  exclude=exclude)
         else:
-            return self.registry.get_engine_for()
+            if self.ro_engines is None:
+                self.ro_engines = {}
+
+            engine = self.ro_engines.get(group)
+            if (
+                engine is None or
+                not self.registry.is_engine_available(engine)
+            ):
+                engine = self.registry.get_engine_for(group=group,
+                                                      exclude=exclude)
+                self.ro_engines[group] = engine
+
+        self.last_ro_engine = engine
+        return engine
+
+    @contextmanager
+    def using(self, target):
+        """Force the engine of the reads in the context manager::
+
+            with session.using('master'):
+                ...
+
+        :param target: ``master``, ``replica``, ``bulk`` or the name of an
+                       engine
+        """
+        routing = self.routing
+        self.routing = target
+        try:
+            yield
+        finally:
+            self.routing = routing
+
+    @contextmanager
+    def bulk_write(self):
+        """Execute the reads and the writes in the context manager on the
+        bulk engine of the master, see ``MultiEngines.get_bulk_engine``
+
+        the bulk write must be the only work of its transaction
+
+        :exception: RegistryException
+        """
+        if self.transaction is not None and self.transaction._connections:
+            raise RegistryException(
+                "The bulk write must start a transaction, commit or "
+                "rollback the current transaction before")
+
+        with self.using('bulk'):
+            yield
+
+    def get_engine_for_routing(self, group=None):
+        """Return the engine forced by ``using``
+
+        :param group: name of the engine group, None for the default engines
+        :rtype: engine
+        :exception: RegistryException
+        """
+        if self.routing == 'master':
+            return self.registry.get_engine_for(ro=False, group=group)
+        elif self.routing == 'replica':
+            return self.get_ro_engine(group=group)
+        elif self.routing == 'bulk':
+            return self.registry.get_bulk_engine(group=group)
+
+        return self.registry.get_engine_by_name(self.routing)
+
+    def must_read_on_master(self):
+        """Return True if the sticky after write mode is enabled and the
+        session wrote in the transaction or in the sticky window after the
+        last transaction with a write
+
+        :rtype: bool
+        """
+        if not self.registry.sticky_after_write:
+            return False
+
+        if self.wrote_on_master:
+            return True
+
+        return EnvironmentManager.get('_sticky_master_until', 0) > time()
+
+    def can_read_from_cache(self):
+        """Return True if the query can use the query cache: the read is
+        routed to a replica and the session has nothing to flush
+
+        :rtype: bool
+        """
+        if self.registry.unittest_transaction:
+            return False
+
+        if self.routing not in (None, 'replica'):
+            return False
+
+        return self._is_clean() and not self.must_read_on_master()
+
+    def invalidate_query_cache(self, tables):
+        """Remove the results of the queries which read the written tables
+        from the query cache, again at the end of the transaction
+
+        :param tables: names of the written tables
+        """
+        if self.written_tables is None:
+            self.written_tables = set()
+
+        self.written_tables.update(tables)
+        self.registry.query_cache.invalidate(tables)
+
+    def can_retry_read(self):
+        """Return True if a failed read can be executed again on another
+        engine: the transaction did not use any connection and there is
+        nothing to flush
+
+        :rtype: bool
+        """
+        if self.registry.unittest_transaction or not self._is_clean():
+            return False
+
+        transaction = self.transaction
+        return transaction is None or not transaction._connections
+
+    def exclude_engine(self, engine):
+        """Do not choose the read only engine until the end of the next
+        transaction
+
+        :param engine: read only engine which failed
+        """
+        if self.excluded_engines is None:
+            self.excluded_engines = set()
+
+        self.excluded_engines.add(engine)
+
+    def end_of_transaction(self):
+        """Called at the end of the main transaction (commit or rollback)
+        to release the routing state of the session
+        """
+        if self.wrote_on_master and self.registry.sticky_window:
+            EnvironmentManager.set('_sticky_master_until',
+                                   time() + self.registry.sticky_window)
+
+        if self.written_tables:
+            # the other sessions could read the old rows before the commit
+            self.registry.query_cache.invalidate(self.written_tables)
+            self.written_tables = None
+
+        self.wrote_on_master = False
+        self.ro_engines = None
+        self.last_ro_engine = None
+        self.excluded_engines = None
+        self.last_written_engines = self.written_engines
+        self.written_engines = None
+
+
+class MixinQuery:
+    """Mixin for the SQLAlchemy query the goal is to force the engine
+    used by the query::
+
+        registry.System.Blok.query().on_master().all()
+        registry.System.Blok.query().on_replica('reporting').all()
+    """
+
+    routing = None
+    cache = False
+    cache_ttl = None
+
+    def using(self, target):
+        """Return a copy of the query executed on the target
+
+        :param target: ``master``, ``replica`` or the name of an engine
+        :rtype: Query
+        """
+        query = self._clone()
+        query.routing = target
+        return query
+
+    def on_master(self):
+        """Return a copy of the query executed on the master"""
+        return self.using('master')
+
+    def on_replica(self, name=None):
+        """Return a copy of the query executed on a read only engine
+
+        :param name: name of the read only engine, if None the engine is
+                     chosen by the balancer
+        """
+        return self.using(name or 'replica')
+
+    def cached(self, ttl=None):
+        """Return a copy of the query whose result is saved in the query
+        cache of the registry (``db_query_cache_size``)::
+
+            registry.System.Parameter.query().filter_by(key=key).cached()
+
+        the result is read from the cache while no flush writes in one of
+        the tables of the query and until the time to live
+
+        :param ttl: time to live in seconds, by default
+                    ``db_query_cache_ttl``
+        """
+        query = self._clone()
+        query.cache = True
+        query.cache_ttl = ttl
+        return query
+
+    def __iter__(self):
+        if self.routing is None:
+            return self.iter_from_cache()
+
+        with self.session.using(self.routing):
+            return self.iter_from_cache()
+
+    def iter_from_cache(self):
+        """Execute the query or read its result in the query cache, the
+        instances of the cache are merged in the session without load
+        """
+        session = self.session
+        cache = session.registry.query_cache
+        if not self.cache or cache is None:
+            return self.iter_with_retries()
+
+        if self._autoflush:
+            session._autoflush()
+
+        if not session.can_read_from_cache():
+            return self.iter_with_retries()
+
+        statement = self.statement
+        key = self.get_cache_key(statement)
+        result = cache.get(key)
+        if result is not None:
+            return self.merge_result(result, load=False)
+
+        since = cache.snapshot()
+        result = list(self.iter_with_retries())
+        detached_result = self.detach_result(result)
+        if detached_result is not None:
+            tables = {table.fullname for table in find_tables(statement)}
+            cache.set(key, tables, detached_result, ttl=self.cache_ttl,
+                      since=since)
+
+        return iter(result)
+
+    def get_cache_key(self, statement):
+        """Return the key of the query in the query cache, made with the
+        engine group, the compiled SQL and its parameters
+
+        :param statement: select statement of the query
+        """
+        registry = self.session.registry
+        compiled = statement.compile(dialect=registry.engine.dialect)
+        group = registry.get_engine_group(self._bind_mapper())
+        return (group, str(compiled), repr(sorted(compiled.params.items())))
+
+    def detach_result(self, result):
+        """Return a copy of the result, with instances which are not in a
+        session, or None if the result can not be copied
+        """
+        cache_session = self.session.registry.Session.session_factory()
+        try:
+            return list(self.with_session(cache_session).merge_result(
+                result, load=False))
+        except InvalidRequestError:
+            # the instances modified in the session can not be copied
+            return None
+        finally:
+            cache_session.expunge_all()
+            cache_session.close()
+
+    def iter_with_retries(self):
+        """Execute the query, if the connection of the read only engine is
+        lost then the transaction is rolled back and the query is executed
+        again on another engine, ``db_ro_retries`` times at most. The other
+        OperationalError are raised, the query would fail again
+
+        Only the query which is the first work of its transaction is
+        executed again, else the work done before would be lost
+        """
+        session = self.session
+        retries = session.registry.ro_retries
+        if not retries or not session.can_retry_read():
+            return super(MixinQuery, self).__iter__()
+
+        backoff = session.registry.ro_retry_backoff
+        for retry in range(retries + 1):
+            session.last_ro_engine = None
+            try:
+                return super(MixinQuery, self).__iter__()
+            except OperationalError as e:
+                engine = session.last_ro_engine
+                if (
+                    engine is None or retry == retries or
+                    not e.connection_invalidated
+                ):
+                    raise
+
+                logger.warning('Read failed on the engine %r, retry on '
+                               'another engine: %s', engine, e)
+                session.rollback()
+                session.exclude_engine(engine)
+                if backoff:
+                    sleep(backoff * 2 ** retry)
+
+
+def create_bulk_engine(url, kwargs):
+    """ Return an engine tuned for the bulk writes, see
+    ``MultiEngines.get_bulk_engine``
+
+    :param url: url of the master
+    :param kwargs: options of the engine of the master
+    :rtype: engine
+    """
+    kwargs = dict(kwargs, max_overflow=0,
+                  pool_size=Configuration.get('db_bulk_pool_size') or 1)
+    settings = []
+    if url.get_dialect().name == 'postgresql':
+        if url.get_dialect().driver == 'psycopg2':
+            kwargs.update(
+                executemany_mode='values',
+                executemany_values_page_size=(
+                    Configuration.get('db_bulk_page_size') or 1000))
+
+        timeout = Configuration.get('db_bulk_statement_timeout')
+        if timeout is not None:
+            settings.append('SET statement_timeout = %d' % (timeout * 1000))
+
+        synchronous_commit = Configuration.get('db_bulk_synchronous_commit')
+        if synchronous_commit:
+            settings.append('SET synchronous_commit = %s' % synchronous_commit)
+
+    engine = create_engine(url, **kwargs)
+    execute_on_connect(engine, settings)
+    return engine
+
+
+@contextmanager
+def bulk_write(registry):
+    """ Context manager of ``MultiEngines.bulk_write`` """
+    with registry.session.bulk_write():
+        try:
+            yield
+            registry.commit()
+        except Exception:
+            registry.rollback()
+            raise
+
+
+def before_flush(session, flush_context, instances):
+    """SQLAlchemy event, reject the flushes of a read only registry before
+    the choice of the engine
+
+    :exception: RegistryException
+    """
+    if session.new or session.dirty or session.deleted:
+        raise RegistryException(
+            "The registry is read only, no write is allowed")
+
+
+def after_flush(session, flush_context):
+    """SQLAlchemy event, invalidate the query cache for the tables written
+    by the flush
+    """
+    if session.registry.query_cache is None:
+        return
+
+    tables = set()
+    for instance in chain(session.new, session.dirty, session.deleted):
+        tables.update(table.fullname
+                      for table in object_mapper(instance).tables)
+
+    if tables:
+        session.invalidate_query_cache(tables)
+
+
+def after_bulk_change(update_context):
+    """SQLAlchemy event, invalidate the query cache for the table written
+    by ``Query.update`` or ``Query.delete``
+    """
+    session = update_context.session
+    if session.registry.query_cache is not None:
+        session.invalidate_query_cache(
+            {update_context.primary_table.fullname})
+
+
+def after_transaction_end(session, transaction):
+    """SQLAlchemy event, release the routing state of the session at the end
+    of the main transaction
+    """
+    if transaction.parent is None:
+        session.end_of_transaction()
+
+
+def execute_on(engine, query, params=None, timeout=None):
+    """ Execute the query with a new connection of the engine
+
+    :param engine: engine to query
+    :param query: SQL string, SQLAlchemy statement or callable which takes
+                  the connection and returns the result
+    :param params: parameters of the query
+    :param timeout: seconds, the server cancels the query after this time,
+                    see ``STATEMENT_TIMEOUT``
+    :rtype: result of the callable or list of the rows
+    """
+    with engine.connect() as connection:
+        with connection.begin():
+            statement = STATEMENT_TIMEOUT.get(engine.dialect.name)
+            if timeout and statement:
+                connection.execute(text(statement % (timeout * 1000)))
+
+            if callable(query):
+                return query(connection)
+
+            if isinstance(query, str):
+                query = text(query)
+
+            return connection.execute(query, params or {}).fetchall()
+
+
+def prewarm_connection(engine, statements):
+    """ Open a connection and execute the statements, the connection is
+    returned open so that the connections of the same engine are different
+
+    :param engine: engine to prewarm
+    :param statements: list of SQLAlchemy statements
+    :rtype: Connection
+    """
+    connection = engine.connect()
+    try:
+        for statement in statements:
+            connection.execute(statement)
+    except Exception:
+        connection.close()
+        raise
+
+    return connection
+
+
+def close_prewarmed_connection(future):
+    """ Close the connection of a prewarm which ended after the timeout """
+    if not future.cancelled() and not future.exception():
+        future.result().close()
 
 
 class MultiEngines:
@@ -58,6 +632,26 @@ class MultiEngines:
         * db_url: read and write engine
         * db_ro_urls: read only engines (list)
         * db_wo_url: write only engines
+        * db_ro_pool_*, db_wo_pool_*: pool options by role
+        * db_ro_balancer: strategy to choose the read only engine
+        * db_zone: zone of the worker, to prefer the local read only engines
+        * db_ro_health_check_*: health checker of the read only engines
+        * db_ro_max_lag: max replication lag of the read only engines
+        * db_ro_breaker_*: circuit breaker of the read only engines
+        * db_sticky_after_write: read on the master after a write
+        * db_ro_session_affinity: one read only engine by transaction
+        * db_read_your_writes, db_ro_lsn_wait: read the replicas which
+          replayed the last write
+        * db_ro_retries, db_ro_retry_backoff: retries of the failed reads
+        * db_metrics: routing and pool metrics
+        * db_group_wo_urls, db_group_ro_urls, db_group_models: engine groups
+        * db_share_engines: share the pools with the other registries
+        * db_query_cache_size, db_query_cache_ttl: cache of the query results
+        * db_prewarm_connections, db_prewarm_sql: open the connections
+        * db_bulk_*: options of the bulk engines
+        * db_read_only: registry without master, the read only registry
+          never migrates nor writes, also without ``db_wo_url`` and
+          ``db_url``
 
         .. warning::
 
@@ -66,59 +660,705 @@ class MultiEngines:
         :param db_name: name of the database for the engines
         """
         kwargs = self.init_engine_options()
-        gurl = Configuration.get('get_url', get_url)
         self.engines = {'ro': [], 'wo': None}
+        self.engines_options = {}
+        self.engines_by_name = {}
+        self.engines_arguments = {}
+        self.bulk_engines = {}
+        self.bulk_lock = Lock()
         self._engine = None
+        self.sticky_after_write = Configuration.get('db_sticky_after_write')
+        self.sticky_window = Configuration.get('db_sticky_window') or 0
+        self.session_affinity = Configuration.get('db_ro_session_affinity')
+        self.zone = Configuration.get('db_zone')
+        self.read_your_writes = Configuration.get('db_read_your_writes')
+        self.lsn_wait = Configuration.get('db_ro_lsn_wait') or 0
+        self.replay_lsns = {}
+        self.query_cache = None
+        if Configuration.get('db_query_cache_size'):
+            self.query_cache = QueryCache(
+                Configuration.get('db_query_cache_size'),
+                Configuration.get('db_query_cache_ttl') or 60,
+                grace=max(Configuration.get('db_ro_max_lag') or 0,
+                          self.sticky_window))
+        self.ro_retries = Configuration.get('db_ro_retries') or 0
+        self.ro_retry_backoff = Configuration.get('db_ro_retry_backoff') or 0
+        self.read_only = Configuration.get('db_read_only')
+        self.metrics = None
+        if Configuration.get('db_metrics'):
+            self.metrics = Metrics(
+                self, callback=Configuration.get('db_metrics_callback'))
 
-        for url in Configuration.get('db_ro_urls', []) or []:
-            url = gurl(db_name=db_name, url=url)
-            engine = create_engine(url, **kwargs)
-            self.engines['ro'].append(engine)
+        self.init_default_engines(db_name, **kwargs)
+        self.init_engine_groups(db_name, **kwargs)
+        self.init_balancer()
+        self.init_monitors()
+        self.init_circuit_breaker()
+        self.prewarm_engines()
 
-        wo_url = Configuration.get('db_wo_url')
-        if wo_url:
-            url = gurl(db_name=db_name, url=wo_url)
-            engine = create_engine(url, **kwargs)
-            self.engines['wo'] = engine
+    def init_default_engines(self, db_name, **kwargs):
+        """Create the master and the read only engines of the registry
+
+        without master the registry is read only
 
+        :param db_name: name of the database for the engines
+        """
+        ro_urls = Configuration.get('db_ro_urls', []) or []
+        wo_url = Configuration.get('db_wo_url')
         url = Configuration.get('db_url')
         if url and wo_url:
             raise RegistryException(
                 "You have not to use the both Configuration option "
                 "--get-wo-url [%s] and --get-url [%s], chose only one of them "
                 "because only one master can be chose" % (wo_url, url))
-        elif url:
-            url = gurl(db_name=db_name, url=url)
-            engine = create_engine(url, **kwargs)
-            self.engines['wo'] = engine
+
+        if ro_urls and not wo_url and not url:
+            self.read_only = True
+
+        if self.read_only:
+            logger.debug('No WRITE engine defined use READ ONLY mode')
+            self.loadwithoutmigration = True
+
+        for ro_url in ro_urls:
+            engine = self.create_engine_for(db_name, ro_url, 'ro', **kwargs)
             self.engines['ro'].append(engine)
 
-        if not self.engines['ro'] and not self.engines['wo']:
-            url = gurl(db_name=db_name)
-            engine = create_engine(url, **kwargs)
+        if self.read_only:
+            if not self.engines['ro']:
+                engine = self.create_engine_for(
+                    db_name, wo_url or url or None, 'ro', **kwargs)
+                self.engines['ro'].append(engine)
+        elif wo_url:
+            engine = self.create_engine_for(db_name, wo_url, 'wo', **kwargs)
+            self.engines['wo'] = engine
+        else:
+            engine = self.create_engine_for(db_name, url or None, 'wo',
+                                            **kwargs)
             self.engines['wo'] = engine
             self.engines['ro'].append(engine)
-        elif not self.engines['wo']:
-            logger.debug('No WRITE engine defined use READ ONLY mode')
-            self.loadwithoutmigration = True
 
-    def get_engine_for(self, ro=True):
+    def init_engine_groups(self, db_name, **kwargs):
+        """Create the engines of the engine groups
+
+        an engine group has its own master and its own read only engines,
+        the models use the engines of their group, given by
+        ``db_group_models`` or by the ``__engine_group__`` attribute of the
+        model::
+
+            @register(Model)
+            class Audit:
+                __engine_group__ = 'archive'
+
+        the other models use the group of the ``db_group`` key of the
+        environment, by default the engines of the registry.
+
+        The read only engines of a group without replica is its master, the
+        master of a group without master is the master of the registry, for
+        example a group with only a reporting replica
+
+        .. warning::
+
+            The tables are created and migrated only by the default master,
+            the tables of the models in a group must exist in its database
+
+        The masters of the groups are ignored by a read only registry
+
+        :param db_name: name of the database for the engines
+        """
+        self.engine_groups = {}
+        self.group_models = dict(get_mapping(
+            Configuration.get('db_group_models')))
+        for group, url in get_mapping(Configuration.get('db_group_wo_urls')):
+            if self.read_only:
+                continue
+
+            engines = self.engine_groups.setdefault(
+                group, {'ro': [], 'wo': None})
+            if engines['wo']:
+                raise RegistryException(
+                    "Only one master can be chose for the engine group "
+                    "%r" % group)
+
+            engines['wo'] = self.create_engine_for(
+                db_name, url, 'wo', **kwargs)
+
+        for group, url in get_mapping(Configuration.get('db_group_ro_urls')):
+            engines = self.engine_groups.setdefault(
+                group, {'ro': [], 'wo': None})
+            engines['ro'].append(self.create_engine_for(
+                db_name, url, 'ro', **kwargs))
+
+        for engines in self.engine_groups.values():
+            if not engines['ro'] and engines['wo']:
+                engines['ro'].append(engines['wo'])
+            elif not engines['wo']:
+                engines['wo'] = self.engines['wo']
+
+    def init_balancer(self):
+        """Create the balancer of the read only engines"""
+        self.balancer = get_balancer(
+            Configuration.get('db_ro_balancer', 'random'))(self)
+        for engine in self.get_all_ro_engines():
+            self.balancer.listen(engine)
+
+    def init_monitors(self):
+        """Start the daemon threads which check the read only engines"""
+        self.health_checker = self.lag_monitor = None
+        timeout = Configuration.get('db_ro_health_check_timeout')
+        interval = Configuration.get('db_ro_health_check_interval')
+        if interval:
+            self.health_checker = HealthChecker(
+                self, interval, timeout or interval,
+                rise=Configuration.get('db_ro_health_check_rise') or 1)
+            self.health_checker.start()
+
+        max_lag = Configuration.get('db_ro_max_lag')
+        if max_lag:
+            interval = Configuration.get('db_ro_lag_check_interval') or 5
+            self.lag_monitor = LagMonitor(self, interval, timeout or interval,
+                                          max_lag)
+            self.lag_monitor.start()
+
+    def init_circuit_breaker(self):
+        """Listen the errors of the read only engines to open their
+        circuit breaker"""
+        self.circuit_breaker = None
+        errors = Configuration.get('db_ro_breaker_errors')
+        if errors:
+            self.circuit_breaker = CircuitBreaker(
+                errors, Configuration.get('db_ro_breaker_window') or 10,
+                Configuration.get('db_ro_breaker_cooldown') or 30)
+            for engine in self.get_all_ro_engines():
+                self.circuit_breaker.listen(engine)
+
+    def prewarm_engines(self):
+        """ Open ``db_prewarm_connections`` connections by engine in
+        parallel and execute the ``db_prewarm_sql`` statements on them, then
+        return the connections to the pools
+
+        the connections are waited ``db_prewarm_timeout`` seconds at most,
+        an engine which fails is only logged
+        """
+        number = Configuration.get('db_prewarm_connections')
+        if not number:
+            return
+
+        statements = [text(statement) for statement in get_statements(
+            Configuration.get('db_prewarm_sql') or [])]
+        jobs = []
+        for engine in self.get_engines():
+            if isinstance(engine.pool, QueuePool):
+                jobs.extend([engine] * min(number, engine.pool.size()))
+            else:
+                jobs.extend([engine] * number)
+
+        futures = {submit_in_thread('prewarm(%r)' % engine, prewarm_connection,
+                                    engine, statements): engine
+                   for engine in jobs}
+        wait(futures, timeout=Configuration.get('db_prewarm_timeout'))
+
+        failed = set()
+        for future, engine in futures.items():
+            if not future.done():
+                future.add_done_callback(close_prewarmed_connection)
+                error = 'timeout'
+            elif future.exception():
+                error = future.exception()
+            else:
+                future.result().close()
+                continue
+
+            if engine not in failed:
+                failed.add(engine)
+                logger.warning('The prewarm of %r failed: %s', engine, error)
+
+    def stop_monitors(self):
+        """Stop the daemon threads which check the read only engines"""
+        for monitor in (self.health_checker, self.lag_monitor):
+            if monitor:
+                monitor.stop()
+
+    def create_engine_for(self, db_name, url, role, **kwargs):
+        """ Create one engine and save the options given by the url
+
+        The pool options (pool_size, max_overflow, pool_recycle) come from,
+        by priority:
+
+        * the options of the url
+        * the Configuration of the role: db_ro_pool_size, db_wo_pool_size, ...
+        * the kwargs
+
+        with ``db_share_engines`` the pool is shared with the other registries
+        of the process, see ``SharedEngines``
+
+        :param db_name: name of the database for the engine
+        :param url: complete url with the options, or None for the
+                    url defined by the configuration
+        :param role: ``ro`` or ``wo``
+        :rtype: engine
+        """
+        options = {}
+        if url:
+            url, options = get_url_options(url)
+
+        kwargs = kwargs.copy()
+        for key in POOL_OPTIONS:
+            value = options.get(
+                key, Configuration.get('db_%s_%s' % (role, key)))
+            if value is not None:
+                kwargs[key] = value
+
+        url = Configuration.get('get_url', get_url)(db_name=db_name, url=url)
+        statements = self.get_connect_statements(url)
+        if Configuration.get('db_share_engines'):
+            engine = SHARED_ENGINES.acquire(url, role, statements=statements,
+                                            **kwargs)
+        else:
+            engine = create_engine(url, **kwargs)
+            execute_on_connect(engine, statements)
+
+        self.engines_options[engine] = options
+        self.engines_arguments[engine] = (url, {
+            key: kwargs[key] for key in POOL_OPTIONS if key in kwargs})
+        if options.get('name'):
+            self.engines_by_name[options['name']] = engine
+
+        return engine
+
+    def get_engine_options(self, engine):
+        """ Return the options given by the url of the engine
+
+        :param engine: engine created by the registry
+        :rtype: dict
+        """
+        return self.engines_options.get(engine, {})
+
+    def get_connect_statements(self, url):
+        """ Return the statements executed on the new connections of the
+        engine of the url, the transactions of a read only registry are read
+        only, see ``READ_ONLY_TRANSACTION``
+
+        :param url: SQLAlchemy URL of the engine
+        :rtype: list of SQL strings
+        """
+        statement = READ_ONLY_TRANSACTION.get(url.get_dialect().name)
+        if self.read_only and statement:
+            return [statement]
+
+        return []
+
+    def get_engine_arguments(self, engine):
+        """ Return the url and the pool options used to create the engine
+
+        :param engine: engine created by the registry
+        :rtype: tuple(url, dict of the pool options)
+        """
+        return self.engines_arguments[engine]
+
+    def get_engines(self):
+        """ Return all the engines of the registry, with the engines of the
+        engine groups
+
+        :rtype: list of engines
+        """
+        engines = []
+        for group in [self.engines] + list(self.engine_groups.values()):
+            for engine in group['ro'] + [group['wo']]:
+                if engine is not None and engine not in engines:
+                    engines.append(engine)
+
+        return engines
+
+    def get_all_ro_engines(self):
+        """ Return the read only engines of the registry, with the read
+        only engines of the engine groups
+
+        :rtype: list of engines
+        """
+        engines = []
+        for group in [self.engines] + list(self.engine_groups.values()):
+            engines.extend(engine for engine in group['ro']
+                           if engine not in engines)
+
+        return engines
+
+    def get_group_engines(self, group=None):
+        """ Return the engines of the engine group
+
+        :param group: name of the engine group, None for the default engines
+        :rtype: dict {'ro': list of engines, 'wo': engine}
+        :exception: RegistryException
+        """
+        if group is None:
+            return self.engines
+
+        if group not in self.engine_groups:
+            raise RegistryException("Unknown engine group %r" % group)
+
+        return self.engine_groups[group]
+
+    def get_engine_group(self, mapper=None):
+        """ Return the engine group of the mapper
+
+        the group is given, by priority:
+
+        * by ``db_group_models`` for the model of the mapper
+        * by the ``__engine_group__`` attribute of the model of the mapper
+        * by the ``db_group`` key of the environment
+
+        :param mapper: SQLAlchemy mapper or mapped class given to
+                       ``get_bind``
+        :rtype: name of the group or None for the default engines
+        """
+        if not self.engine_groups:
+            return None
+
+        if mapper is not None:
+            model = inspect(mapper).class_
+            name = getattr(model, '__registry_name__', None)
+            if name in self.group_models:
+                return self.group_models[name]
+
+            group = getattr(model, '__engine_group__', None)
+            if group:
+                return group
+
+        return EnvironmentManager.get('db_group')
+
+    @contextmanager
+    def using_group(self, group):
+        """ Use the engine group for the models without group in the context
+        manager, for example the group of a tenant::
+
+            with registry.using_group('tenant1'):
+                ...
+
+        :param group: name of the engine group, None for the default engines
+        """
+        self.get_group_engines(group)
+        previous = EnvironmentManager.get('db_group')
+        EnvironmentManager.set('db_group', group)
+        try:
+            yield
+        finally:
+            EnvironmentManager.set('db_group', previous)
+
+    def get_engine_name(self, engine):
+        """ Return the ``name`` option of the url of the engine, or the url
+        without the password
+
+        :param engine: engine or connection
+        :rtype: str
+        """
+        engine = engine.engine
+        return self.get_engine_options(engine).get('name') or repr(engine.url)
+
+    def get_engine_by_name(self, name):
+        """ Return the engine with the ``name`` option in its url::
+
+            postgresql://replica1/db?name=reporting
+
+        :param name: name of the engine
+        :rtype: engine
+        :exception: RegistryException
+        """
+        if name not in self.engines_by_name:
+            raise RegistryException("No engine found with the name %r" % name)
+
+        return self.engines_by_name[name]
+
+    def using(self, target):
+        """ Force the engine of the reads of the session in the context
+        manager::
+
+            with registry.using('master'):
+                registry.System.Blok.query().all()
+
+        :param target: ``master``, ``replica`` or the name of an engine
+        """
+        return self.session.using(target)
+
+    def is_engine_available(self, engine):
+        """ Return False if the engine must not receive read queries
+
+        :param engine: read only engine
+        :rtype: bool
+        """
+        if self.health_checker and not self.health_checker.is_healthy(engine):
+            return False
+
+        if self.lag_monitor and self.lag_monitor.is_lagging(engine):
+            return False
+
+        if (
+            self.circuit_breaker and
+            not self.circuit_breaker.is_allowed(engine)
+        ):
+            return False
+
+        return True
+
+    def get_ro_engines(self, engines=None, exclude=None):
+        """ Return the read only engines which can be used
+
+        if ``db_zone`` is defined, the available engines with the same
+        ``zone`` option in their url are preferred::
+
+            postgresql://replica1/db?zone=eu-west-1a
+
+        if no read only engine is available then the write engine is used,
+        and if there is no write engine, all the read only engines are used
+
+        :param engines: engines of a group, by default the engines of the
+                        registry
+        :param exclude: engines which must not be used
+        :rtype: list of engines
+        """
+        if engines is None:
+            engines = self.engines
+
+        ro_engines = [engine for engine in engines['ro']
+                      if (not exclude or engine not in exclude) and
+                      self.is_engine_available(engine)]
+        if self.zone and len(ro_engines) > 1:
+            local_engines = [
+                engine for engine in ro_engines
+                if self.get_engine_options(engine).get('zone') == self.zone]
+            if local_engines:
+                return local_engines
+
+        if ro_engines or not engines['ro']:
+            return ro_engines
+
+        if engines['wo']:
+            return [engines['wo']]
+
+        return engines['ro']
+
+    def save_write_positions(self, engines):
+        """ Save the WAL position of the masters in the environment, the
+        next reads use only the replicas which replayed this position
+
+        :param engines: masters written by the transaction
+        """
+        positions = dict(EnvironmentManager.get('_write_positions') or {})
+        for engine in engines:
+            try:
+                lsn = get_current_lsn(engine)
+            except Exception as e:
+                logger.warning('Unknown WAL position of %r: %s', engine, e)
+                lsn = None
+
+            if lsn is not None:
+                positions[engine] = lsn
+
+        EnvironmentManager.set('_write_positions', positions)
+
+    def get_replay_lsn(self, engine):
+        """ Read and save the WAL position replayed by the replica
+
+        :param engine: read only engine
+        :rtype: int or None
+        """
+        try:
+            lsn = get_replay_lsn(engine)
+        except Exception as e:
+            logger.debug('Unknown WAL position of %r: %s', engine, e)
+            return None
+
+        if lsn is not None:
+            self.replay_lsns[engine] = max(
+                lsn, self.replay_lsns.get(engine, lsn))
+
+        return lsn
+
+    def get_caught_up_engines(self, engines, master):
+        """ Return the read only engines which replayed the last write of
+        the environment on the master
+
+        the positions already read are used first, else the replicas are
+        read until one of them replays the position, during ``db_ro_lsn_wait``
+        seconds at most, then the master is used
+
+        :param engines: available read only engines
+        :param master: master of the engines
+        :rtype: list of engines
+        """
+        positions = EnvironmentManager.get('_write_positions')
+        if not positions or master not in positions:
+            return engines
+
+        position = positions[master]
+        caught_up = [engine for engine in engines
+                     if engine is master or
+                     self.replay_lsns.get(engine, -1) >= position]
+        deadline = monotonic() + self.lsn_wait
+        while not caught_up:
+            caught_up = [engine for engine in engines
+                         if (self.get_replay_lsn(engine) or -1) >= position]
+            if caught_up or monotonic() >= deadline:
+                break
+
+            sleep(0.01)
+
+        return caught_up or [master]
+
+    def get_bulk_engine(self, group=None):
+        """ Return the bulk engine of the master of the group, created at
+        the first call
+
+        the bulk engine uses the url of the master with its own small pool
+        (``db_bulk_pool_size``), for PostgreSQL with psycopg2:
+
+        * the rows of the executemany are sent by pages of
+          ``db_bulk_page_size`` rows
+        * ``db_bulk_statement_timeout`` and ``db_bulk_synchronous_commit``
+          are set on the connections
+
+        :param group: name of the engine group, None for the default engines
+        :rtype: engine
+        """
+        master = self.get_engine_for(ro=False, group=group)
+        engine = self.bulk_engines.get(master)
+        if engine is not None:
+            return engine
+
+        with self.bulk_lock:
+            if master not in self.bulk_engines:
+                url, kwargs = self.get_engine_arguments(master)
+                kwargs = dict(self.init_engine_options(), **kwargs)
+                self.bulk_engines[master] = create_bulk_engine(url, kwargs)
+
+            return self.bulk_engines[master]
+
+    def bulk_write(self):
+        """ Context manager to write a lot of rows with the bulk engine,
+        the transaction is committed at the end::
+
+            with registry.bulk_write():
+                registry.Model.multi_insert(*values)
+
+        :exception: RegistryException
+        """
+        return bulk_write(self)
+
+    def get_engine_for(self, ro=True, group=None, exclude=None):
         """ Return one engine among the engines
 
         :param ro: if True the engine will be read only else write only
+        :param group: name of the engine group, None for the default engines
+        :param exclude: read only engines which must not be used
         :rtype: engine
         :exception: RegistryException
         """
-        engines = self.engines['ro'] if ro else self.engines['wo']
+        engines = self.get_group_engines(group)
+        if ro:
+            master = engines['wo']
+            engines = self.get_ro_engines(engines, exclude=exclude)
+            if self.read_your_writes and engines:
+                engines = self.get_caught_up_engines(engines, master)
+        else:
+            engines = engines['wo']
+
         if not engines:
             raise RegistryException("No engine found for do action %r" % (
                 "read" if ro else "write"))
 
         if ro:
-            return choice(engines)
+            return self.choose_ro_engine(engines)
 
         return engines
 
+    def choose_ro_engine(self, engines):
+        """ Return the read only engine chosen by the balancer, an engine
+        refused by its circuit breaker is replaced by another choice
+
+        :param engines: available read only engines
+        :rtype: engine
+        """
+        engines = list(engines)
+        while True:
+            engine = self.balancer.choice(engines)
+            if (
+                self.circuit_breaker is None or
+                self.circuit_breaker.admit(engine) or len(engines) == 1
+            ):
+                return engine
+
+            engines.remove(engine)
+
+    def fanout(self, query, params=None, engines=None, group=None,
+               timeout=None):
+        """ Execute the query on all the read only engines in parallel::
+
+            for engine, rows, error in registry.fanout(
+                'SELECT count(*) FROM audit'
+            ):
+                ...
+
+        each engine uses its own connection, outside of the session, in its
+        own thread
+
+        :param query: SQL string, SQLAlchemy statement or callable which
+                      takes the connection and returns the result
+        :param params: parameters of the query
+        :param engines: engines to query, by default the read only engines
+                        of the group
+        :param group: name of the engine group, None for the default engines
+        :param timeout: seconds to wait the results, by default
+                        ``db_fanout_timeout``, the engines without answer
+                        give a TimeoutError. The timeout is also given to
+                        the server, which cancels the query
+        :rtype: generator of (engine, result, exception) in the order of
+                the answers, the result of a query is the list of the rows
+        """
+        if engines is None:
+            engines = self.get_group_engines(group)['ro']
+
+        if timeout is None:
+            timeout = Configuration.get('db_fanout_timeout') or None
+
+        futures = {
+            submit_in_thread('fanout(%r)' % engine, execute_on, engine, query,
+                             params, timeout): engine
+            for engine in engines}
+        try:
+            for future in as_completed(futures, timeout=timeout):
+                engine = futures.pop(future)
+                error = future.exception()
+                yield engine, None if error else future.result(), error
+        except FuturesTimeoutError:
+            for future, engine in futures.items():
+                yield engine, None, TimeoutError(
+                    'No answer after %r seconds' % timeout)
+
+    def fanout_merge(self, query, **kwargs):
+        """ Execute the query on all the read only engines in parallel and
+        return all the rows, see ``fanout``
+
+        :param query: SQL string or SQLAlchemy statement
+        :rtype: list of the rows of all the engines
+        :exception: the first error of the engines
+        """
+        rows = []
+        for engine, result, error in self.fanout(query, **kwargs):
+            if error:
+                raise error
+
+            rows.extend(result)
+
+        return rows
+
+    def commit(self, *args, **kwargs):
+        """ Overwrite the commit to save the WAL position of the masters
+        written by the transaction, see ``db_read_your_writes``
+        """
+        session = self.session
+        session.last_written_engines = None
+        super(MultiEngines, self).commit(*args, **kwargs)
+        if session.last_written_engines:
+            self.save_write_positions(session.last_written_engines)
+
     def init_bind(self):
         """ Initialise the bind for unittest"""
         self._bind = None
@@ -142,7 +1382,8 @@ class MultiEngines:
     def engine(self):
         """Return the engine"""
         if not self._engine:
-            self._engine = self.get_engine_for(ro=self.loadwithoutmigration)
+            self._engine = self.get_engine_for(
+                ro=self.loadwithoutmigration or self.read_only)
 
         return self._engine
 
@@ -151,7 +1392,7 @@ class MultiEngines:
         """
         if self.Session is None or self.must_recreate_session_factory():
             if self.Session:
-                if not self.withoutautomigration:
+                if not self.withoutautomigration and not self.read_only:
                     # this is the only case to use commit in the construction
                     # of the registry
                     self.commit()
@@ -160,7 +1401,7 @@ class MultiEngines:
                 # because the instance are cached
                 self.Session.remove()
 
-            query_bases = [] + self.loaded_cores['Query']
+            query_bases = [MixinQuery] + self.loaded_cores['Query']
             query_bases += [self.registry_base]
             Query = type('Query', tuple(query_bases), {})
             session_bases = [self.registry_base, MixinSession]
@@ -172,32 +1413,61 @@ class MultiEngines:
             if extension:
                 extension = extension()
 
+            event.listen(Session, 'after_transaction_end',
+                         after_transaction_end)
+            event.listen(Session, 'after_flush', after_flush)
+            event.listen(Session, 'after_bulk_update', after_bulk_change)
+            event.listen(Session, 'after_bulk_delete', after_bulk_change)
+            if self.read_only:
+                event.listen(Session, 'before_flush', before_flush)
+
             self.Session = scoped_session(
-                sessionmaker(class_=Session, extension=extension),
+                sessionmaker(class_=Session, extension=extension,
+                             autoflush=not self.read_only),
                 EnvironmentManager.scoped_function_for_session())
             self.nb_query_bases = len(self.loaded_cores['Query'])
             self.nb_session_bases = len(self.loaded_cores['Session'])
             self.apply_session_events()
-        else:
+        elif not self.read_only:
             self.flush()
 
+    def apply_model_schema_on_table(self, blok2install):
+        """Overwrite to never migrate the database of a read only registry,
+        also at the reload of the registry
+        """
+        if self.read_only:
+            return False
+
+        return super(MultiEngines, self).apply_model_schema_on_table(
+            blok2install)
+
     def close(self):
         """Overwrite close to cloe all the engines"""
+        self.stop_monitors()
         self.close_session()
-        for engine in self.engines['ro']:
+        self.dispose_engines()
+        for engine in self.bulk_engines.values():
             engine.dispose()
 
-        if self.engines['wo']:
-            self.engines['wo'].dispose()
-
         if self.db_name in RegistryManager.registries:
             del RegistryManager.registries[self.db_name]
 
+    def dispose_engines(self):
+        """Close the connections of the engines, the shared engines are
+        released and closed by the last registry which uses them
+        """
+        for engine in self.get_engines():
+            if SHARED_ENGINES.is_shared(engine):
+                SHARED_ENGINES.release(engine)
+            else:
+                engine.dispose()
+
     @classmethod
-    def db_exists(cls, db_name=None):
-        if not db_name:
-            raise RegistryException('db_name is required')
+    def get_configured_urls(cls):
+        """ Return the urls of all the engines defined by the Configuration
 
+        :rtype: list of url, with their options
+        """
         urls = []
         url = Configuration.get('db_url')
         if url:
@@ -210,15 +1480,41 @@ class MultiEngines:
         for ro_url in Configuration.get('db_ro_urls', []) or []:
             urls.append(ro_url)
 
+        for option in ('db_group_wo_urls', 'db_group_ro_urls'):
+            urls.extend(url for group, url in get_mapping(
+                Configuration.get(option)))
+
+        return urls
+
+    @classmethod
+    def db_exists(cls, db_name=None):
+        """ Check in parallel that the database exists for all the engines
+
+        the checks are waited ``db_exists_timeout`` seconds at most
+
+        :param db_name: name of the database
+        :rtype: bool
+        :exception: RegistryException
+        """
+        if not db_name:
+            raise RegistryException('db_name is required')
+
         gurl = Configuration.get('get_url', get_url)
-        for url in urls:
-            url = gurl(db_name=db_name, url=url)
-            if not database_exists(url):
-                return False
-        else:
-            return database_exists(gurl(db_name=db_name))
+        urls = [gurl(db_name=db_name, url=get_url_options(url)[0])
+                for url in cls.get_configured_urls()]
+        if not urls:
+            urls.append(gurl(db_name=db_name))
 
-        return True
+        timeout = Configuration.get('db_exists_timeout')
+        futures = [submit_in_thread('db_exists', database_exists, url)
+                   for url in urls]
+        done, not_done = wait(futures, timeout=timeout)
+        if not_done:
+            raise RegistryException(
+                "No answer after %r seconds to check if the database %r "
+                "exists" % (timeout, db_name))
+
+        return all(future.result() for future in futures)
 
 
 class RegistryMultiEngines(MultiEngines, Registry):
@@ -0,0 +1,180 @@
+# This file is a part of the AnyBlok Multi Engines project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok_multi_engines.config import copy_url
+from sqlalchemy import create_engine, event, text
+from threading import Lock
+from logging import getLogger
+
+
+logger = getLogger(__name__)
+
+SWITCH_DATABASE = {
+    'mysql': 'USE %s',
+}
+"""Statement to change the database of a connection, by dialect. The
+engines of the dialects without statement are shared only by the
+registries of the same database
+"""
+
+
+def execute_on_connect(engine, statements):
+    """ Execute the statements on each new connection of the pool of the
+    engine, the statements are committed to stay on the connection
+
+    :param engine: engine, the listener is added to its pool
+    :param statements: list of SQL strings
+    """
+    if not statements:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+
+        cursor.close()
+        # SET is rolled back with the transaction
+        dbapi_connection.commit()
+
+
+class SharedEngines:
+    """Engines shared by all the registries of the process
+
+    The engines are keyed by role, url, options and connect statements.
+    For the dialects of ``SWITCH_DATABASE`` the database is neither a part
+    of the key nor of the url of the shared engine, the connections change
+    their database when they are checked out by another registry.
+
+    Each registry gets its own ``OptionEngine`` of the shared engine, with
+    its own url and its own events, the pool is shared: the pool events
+    must be added to the shared engine, see the ``statements`` of
+    ``acquire``. The shared engine is disposed when the last registry
+    releases it
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.engines = {}
+        self.keys = {}
+
+    def get_shared_url(self, url):
+        """ Return the url of the shared engine, without database for the
+        dialects of ``SWITCH_DATABASE``
+
+        :param url: SQLAlchemy URL of a registry
+        :rtype: SQLAlchemy URL
+        """
+        url = copy_url(url)
+        if url.get_dialect().name in SWITCH_DATABASE:
+            url.database = None
+
+        return url
+
+    def get_key(self, url, role, kwargs, statements=()):
+        url = self.get_shared_url(url)
+        return (role, url.__to_string__(hide_password=False),
+                repr(sorted(kwargs.items())), tuple(statements))
+
+    def acquire(self, url, role, statements=(), **kwargs):
+        """ Return an engine for the url, which shares its pool with the
+        engines of the other registries
+
+        :param url: SQLAlchemy URL
+        :param role: ``ro`` or ``wo``
+        :param statements: SQL strings executed on the new connections,
+                           see ``execute_on_connect``
+        :param kwargs: options of ``create_engine``
+        :rtype: OptionEngine
+        """
+        key = self.get_key(url, role, kwargs, statements)
+        with self.lock:
+            if key not in self.engines:
+                shared = create_engine(self.get_shared_url(url), **kwargs)
+                execute_on_connect(shared, statements)
+                self.engines[key] = [shared, 0]
+
+            shared = self.engines[key]
+            shared[1] += 1
+            engine = shared[0].execution_options()
+            self.keys[engine] = key
+
+        engine.url = url
+        dialect = engine.dialect.name
+        if dialect in SWITCH_DATABASE and url.database:
+            self.switch_database(engine, SWITCH_DATABASE[dialect],
+                                 url.database)
+
+        return engine
+
+    def release(self, engine):
+        """ Release the engine, the shared engine is disposed if no other
+        registry uses it
+
+        :param engine: engine returned by ``acquire``
+        """
+        with self.lock:
+            key = self.keys.pop(engine, None)
+            if key is None:
+                return
+
+            shared = self.engines[key]
+            shared[1] -= 1
+            if shared[1]:
+                return
+
+            del self.engines[key]
+
+        shared[0].dispose()
+
+    def is_shared(self, engine):
+        """Return True if the engine was returned by ``acquire``"""
+        return engine in self.keys
+
+    def dispose(self, engine):
+        """ Close the connections of the pool of the engine, except for a
+        shared engine: its pool is also used by the other registries, which
+        may still reach the database
+
+        :param engine: engine of one registry
+        """
+        if not self.is_shared(engine):
+            engine.dispose()
+
+    def switch_database(self, engine, statement, database):
+        """ Change the database of the connections checked out by this
+        engine, if the last registry which used the connection had another
+        database
+
+        :param engine: engine of one registry
+        :param statement: statement to change the database
+        :param database: name of the database of the registry
+        """
+        statement = text(statement % (
+            engine.dialect.identifier_preparer.quote(database)))
+
+        @event.listens_for(engine, 'engine_connect')
+        def engine_connect(conn, branch):
+            if branch:
+                return
+
+            info = conn.connection.info
+            if info.get('database') != database:
+                # the connectionless executions close the connection after
+                # the first statement
+                close_with_result = conn.should_close_with_result
+                conn.should_close_with_result = False
+                try:
+                    conn.execute(statement)
+                finally:
+                    conn.should_close_with_result = close_with_result
+
+                info['database'] = database
+
+
+SHARED_ENGINES = SharedEngines()
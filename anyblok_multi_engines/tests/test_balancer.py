@@ -0,0 +1,147 @@
+# This file is a part of the AnyBlok project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase
+from anyblok.registry import RegistryException
+from anyblok_multi_engines.balancer import (
+    get_balancer, get_checkedout, RandomBalancer, WeightedBalancer,
+    RoundRobinBalancer, LeastConnectionsBalancer, PowerOfTwoChoicesBalancer,
+    EWMABalancer)
+from sqlalchemy import create_engine
+
+
+class MockPool:
+
+    def __init__(self, checkedout):
+        self._checkedout = checkedout
+
+    def checkedout(self):
+        return self._checkedout
+
+
+class MockEngine:
+
+    def __init__(self, checkedout=0, weight=None):
+        self.pool = MockPool(checkedout)
+        self.options = {}
+        if weight is not None:
+            self.options['weight'] = weight
+
+
+class MockRegistry:
+
+    def get_engine_options(self, engine):
+        return engine.options
+
+
+class TestBalancer(TestCase):
+
+    def test_get_balancer(self):
+        self.assertIs(get_balancer('random'), RandomBalancer)
+        self.assertIs(get_balancer('weighted'), WeightedBalancer)
+        self.assertIs(get_balancer('round-robin'), RoundRobinBalancer)
+        self.assertIs(get_balancer('least-connections'),
+                      LeastConnectionsBalancer)
+        self.assertIs(get_balancer('power-of-two-choices'),
+                      PowerOfTwoChoicesBalancer)
+        self.assertIs(get_balancer('ewma'), EWMABalancer)
+
+    def test_get_balancer_with_class(self):
+        self.assertIs(get_balancer(RoundRobinBalancer), RoundRobinBalancer)
+
+    def test_get_balancer_unknown(self):
+        with self.assertRaises(RegistryException):
+            get_balancer('unknown')
+
+    def test_get_checkedout_without_queue_pool(self):
+        engine = MockEngine()
+        engine.pool = object()
+        self.assertEqual(get_checkedout(engine), 0)
+
+    def test_random(self):
+        engines = [MockEngine(), MockEngine()]
+        balancer = RandomBalancer(MockRegistry())
+        self.assertIn(balancer.choice(engines), engines)
+
+    def test_weighted(self):
+        engines = [MockEngine(weight=0), MockEngine(weight=1)]
+        balancer = WeightedBalancer(MockRegistry())
+        for x in range(10):
+            self.assertIs(balancer.choice(engines), engines[1])
+
+    def test_weighted_default_weight(self):
+        engines = [MockEngine(), MockEngine()]
+        balancer = WeightedBalancer(MockRegistry())
+        self.assertIn(balancer.choice(engines), engines)
+
+    def test_round_robin(self):
+        engines = [MockEngine(), MockEngine(), MockEngine()]
+        balancer = RoundRobinBalancer(MockRegistry())
+        self.assertEqual([balancer.choice(engines) for x in range(6)],
+                         engines + engines)
+
+    def test_least_connections(self):
+        engines = [MockEngine(3), MockEngine(1), MockEngine(2)]
+        balancer = LeastConnectionsBalancer(MockRegistry())
+        for x in range(10):
+            self.assertIs(balancer.choice(engines), engines[1])
+
+    def test_power_of_two_choices(self):
+        engines = [MockEngine(3), MockEngine(1)]
+        balancer = PowerOfTwoChoicesBalancer(MockRegistry())
+        for x in range(10):
+            self.assertIs(balancer.choice(engines), engines[1])
+
+    def test_power_of_two_choices_with_one_engine(self):
+        engines = [MockEngine(3)]
+        balancer = PowerOfTwoChoicesBalancer(MockRegistry())
+        self.assertIs(balancer.choice(engines), engines[0])
+
+    def test_ewma_unknown_latency_first(self):
+        engines = [MockEngine(), MockEngine()]
+        balancer = EWMABalancer(MockRegistry())
+        balancer.measured(engines[0], 0.001)
+        for x in range(10):
+            self.assertIs(balancer.choice(engines), engines[1])
+
+    def test_ewma_lowest_latency(self):
+        engines = [MockEngine(), MockEngine()]
+        balancer = EWMABalancer(MockRegistry())
+        balancer.exploration = 0
+        balancer.measured(engines[0], 0.01)
+        balancer.measured(engines[1], 0.001)
+        for x in range(10):
+            self.assertIs(balancer.choice(engines), engines[1])
+
+        for x in range(20):
+            balancer.measured(engines[1], 0.1)
+
+        self.assertIs(balancer.choice(engines), engines[0])
+
+    def test_ewma_with_checked_out_connections(self):
+        engines = [MockEngine(0), MockEngine(9)]
+        balancer = EWMABalancer(MockRegistry())
+        balancer.exploration = 0
+        balancer.measured(engines[0], 0.005)
+        balancer.measured(engines[1], 0.001)
+        self.assertIs(balancer.choice(engines), engines[0])
+
+    def test_ewma_exploration(self):
+        engines = [MockEngine(), MockEngine()]
+        balancer = EWMABalancer(MockRegistry())
+        balancer.exploration = 1
+        balancer.measured(engines[0], 0.01)
+        balancer.measured(engines[1], 0.001)
+        choices = {balancer.choice(engines) for x in range(100)}
+        self.assertIn(engines[0], choices)
+
+    def test_ewma_listen(self):
+        engine = create_engine('sqlite://')
+        balancer = EWMABalancer(MockRegistry())
+        balancer.listen(engine)
+        engine.execute('SELECT 1')
+        self.assertGreater(balancer.latencies[engine], 0)
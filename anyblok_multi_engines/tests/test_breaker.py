@@ -0,0 +1,96 @@
+# This file is a part of the AnyBlok project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase
+from anyblok_multi_engines.breaker import (
+    CircuitBreaker, CLOSED, OPEN, HALF_OPEN)
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+
+
+class MockClock:
+
+    now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+class TestCircuitBreaker(TestCase):
+
+    def get_breaker(self, errors=3, window=10, cooldown=30):
+        clock = MockClock()
+        return CircuitBreaker(errors, window, cooldown, clock=clock), clock
+
+    def test_open_after_errors(self):
+        breaker, clock = self.get_breaker()
+        breaker.failure('engine')
+        breaker.failure('engine')
+        self.assertEqual(breaker.get_state('engine'), CLOSED)
+        breaker.failure('engine')
+        self.assertEqual(breaker.get_state('engine'), OPEN)
+        self.assertFalse(breaker.is_allowed('engine'))
+        self.assertTrue(breaker.is_allowed('other'))
+
+    def test_errors_out_of_the_window(self):
+        breaker, clock = self.get_breaker()
+        breaker.failure('engine')
+        breaker.failure('engine')
+        clock.now = 11
+        breaker.failure('engine')
+        self.assertEqual(breaker.get_state('engine'), CLOSED)
+
+    def test_half_open_then_closed(self):
+        breaker, clock = self.get_breaker(errors=1)
+        breaker.failure('engine')
+        breaker.success('engine')
+        self.assertEqual(breaker.get_state('engine'), OPEN)
+        clock.now = 30
+        self.assertEqual(breaker.get_state('engine'), HALF_OPEN)
+        self.assertTrue(breaker.is_allowed('engine'))
+        self.assertTrue(breaker.admit('engine'))
+        breaker.success('engine')
+        self.assertEqual(breaker.get_state('engine'), CLOSED)
+        self.assertTrue(breaker.admit('engine'))
+
+    def test_half_open_admit_one_probe(self):
+        breaker, clock = self.get_breaker(errors=1)
+        breaker.failure('engine')
+        self.assertFalse(breaker.admit('engine'))
+        clock.now = 30
+        self.assertTrue(breaker.admit('engine'))
+        self.assertFalse(breaker.is_allowed('engine'))
+        self.assertFalse(breaker.admit('engine'))
+        clock.now = 60
+        # the probe is lost, another one is admitted
+        self.assertTrue(breaker.admit('engine'))
+        self.assertFalse(breaker.admit('engine'))
+        breaker.failure('engine')
+        self.assertEqual(breaker.get_state('engine'), OPEN)
+        clock.now = 90
+        self.assertTrue(breaker.admit('engine'))
+
+    def test_half_open_then_open(self):
+        breaker, clock = self.get_breaker(errors=1)
+        breaker.failure('engine')
+        clock.now = 30
+        breaker.failure('engine')
+        self.assertEqual(breaker.get_state('engine'), OPEN)
+        clock.now = 59
+        self.assertEqual(breaker.get_state('engine'), OPEN)
+
+    def test_listen(self):
+        breaker, clock = self.get_breaker(errors=1)
+        engine = create_engine('sqlite://')
+        breaker.listen(engine)
+        with self.assertRaises(OperationalError):
+            engine.execute('SELECT * FROM unknown_table')
+
+        self.assertEqual(breaker.get_state(engine), OPEN)
+        clock.now = 30
+        engine.execute('SELECT 1')
+        self.assertEqual(breaker.get_state(engine), CLOSED)
@@ -0,0 +1,88 @@
+# This file is a part of the AnyBlok project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase
+from anyblok_multi_engines.cache import QueryCache
+
+
+class MockClock:
+
+    now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+class TestQueryCache(TestCase):
+
+    def get_cache(self, size=2, ttl=10):
+        clock = MockClock()
+        return QueryCache(size, ttl, clock=clock), clock
+
+    def test_get_and_set(self):
+        cache, clock = self.get_cache()
+        self.assertIsNone(cache.get('key'))
+        cache.set('key', {'table'}, [1, 2])
+        self.assertEqual(cache.get('key'), [1, 2])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_ttl(self):
+        cache, clock = self.get_cache()
+        cache.set('key1', {'table'}, [1])
+        cache.set('key2', {'table'}, [2], ttl=30)
+        clock.now = 11
+        self.assertIsNone(cache.get('key1'))
+        self.assertEqual(cache.get('key2'), [2])
+        self.assertNotIn('key1', cache.keys_by_table['table'])
+
+    def test_lru(self):
+        cache, clock = self.get_cache()
+        cache.set('key1', {'table1'}, [1])
+        cache.set('key2', {'table2'}, [2])
+        cache.get('key1')
+        cache.set('key3', {'table3'}, [3])
+        self.assertEqual(list(cache.entries), ['key1', 'key3'])
+        self.assertNotIn('table2', cache.keys_by_table)
+
+    def test_invalidate(self):
+        cache, clock = self.get_cache(size=10)
+        cache.set('key1', {'table1'}, [1])
+        cache.set('key2', {'table1', 'table2'}, [2])
+        cache.set('key3', {'table3'}, [3])
+        cache.invalidate({'table2'})
+        self.assertEqual(list(cache.entries), ['key1', 'key3'])
+        cache.invalidate({'table1', 'unknown'})
+        self.assertEqual(list(cache.entries), ['key3'])
+        self.assertEqual(cache.keys_by_table, {'table3': {'key3'}})
+
+    def test_invalidate_during_the_read(self):
+        cache, clock = self.get_cache()
+        since = cache.snapshot()
+        cache.invalidate({'table'})
+        cache.set('key', {'table'}, [1], since=since)
+        self.assertIsNone(cache.get('key'))
+        since = cache.snapshot()
+        cache.invalidate({'other'})
+        cache.set('key', {'table'}, [1], since=since)
+        self.assertEqual(cache.get('key'), [1])
+
+    def test_grace_after_invalidate(self):
+        cache, clock = self.get_cache()
+        cache.grace = 5
+        cache.invalidate({'table'})
+        cache.set('key', {'table'}, [1], since=cache.snapshot())
+        self.assertIsNone(cache.get('key'))
+        clock.now = 5
+        cache.set('key', {'table'}, [1], since=cache.snapshot())
+        self.assertEqual(cache.get('key'), [1])
+
+    def test_clear(self):
+        cache, clock = self.get_cache()
+        cache.set('key', {'table'}, [1])
+        cache.clear()
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(cache.keys_by_table, {})
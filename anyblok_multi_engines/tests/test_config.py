@@ -11,7 +11,8 @@ from anyblok_multi_engines.config import update_database, update_plugins
 from anyblok.tests.testcase import TestCase
 from anyblok.tests.test_config import MockArgumentParser
 from sqlalchemy.engine.url import make_url
-from anyblok_multi_engines.config import get_url
+from anyblok_multi_engines.config import (
+    get_url, get_url_options, get_mapping, get_statements, build_url)
 
 
 old_getParser = config.getParser
@@ -111,6 +112,25 @@ class TestConfiguration(TestCase):
         url = get_url(db_name='anyblok3', url=db_url)
         self.check_url(url, 'postgres://jssuzanne:secret@/anyblok3')
 
+    def test_get_url_cached(self):
+        db_url = 'postgres:///anyblok?sslmode=require'
+        Configuration.update(
+            db_name=None,
+            db_driver_name=None,
+            db_host=None,
+            db_user_name='jssuzanne',
+            db_password=None,
+            db_port=None)
+        build_url.cache_clear()
+        url = get_url(url=db_url)
+        url.query['sslmode'] = 'disable'
+        url = get_url(url=db_url)
+        self.check_url(url, 'postgres://jssuzanne@/anyblok?sslmode=require')
+        self.assertEqual(build_url.cache_info().hits, 1)
+        Configuration.set('db_user_name', 'other')
+        url = get_url(url=db_url)
+        self.check_url(url, 'postgres://other@/anyblok?sslmode=require')
+
     def test_get_url_without_drivername(self):
         Configuration.update(
             db_name=None,
@@ -122,6 +142,55 @@ class TestConfiguration(TestCase):
         with self.assertRaises(ConfigurationException):
             get_url()
 
+    def test_get_url_options(self):
+        url, options = get_url_options('postgres:///anyblok?weight=4')
+        self.check_url(make_url(url), 'postgres:///anyblok')
+        self.assertEqual(options, {'weight': 4.})
+
+    def test_get_url_options_with_pool_options(self):
+        url, options = get_url_options(
+            'postgres:///anyblok?pool_size=20&max_overflow=5&pool_recycle=60')
+        self.check_url(make_url(url), 'postgres:///anyblok')
+        self.assertEqual(options, {'pool_size': 20, 'max_overflow': 5,
+                                   'pool_recycle': 60})
+
+    def test_get_url_options_with_zone(self):
+        url, options = get_url_options(
+            'postgres:///anyblok?zone=eu-west-1a&name=replica1')
+        self.check_url(make_url(url), 'postgres:///anyblok')
+        self.assertEqual(options, {'zone': 'eu-west-1a', 'name': 'replica1'})
+
+    def test_get_url_options_without_option(self):
+        url, options = get_url_options('postgres:///anyblok?sslmode=require')
+        self.assertEqual(make_url(url).query, {'sslmode': 'require'})
+        self.assertEqual(options, {})
+
+    def test_get_mapping(self):
+        self.assertEqual(
+            get_mapping(['group1=postgres:///anyblok?weight=2',
+                         ' group2 = postgres:///anyblok']),
+            [('group1', 'postgres:///anyblok?weight=2'),
+             ('group2', 'postgres:///anyblok')])
+
+    def test_get_mapping_without_value(self):
+        self.assertEqual(get_mapping(None), [])
+
+    def test_get_mapping_without_key(self):
+        with self.assertRaises(ConfigurationException):
+            get_mapping(['postgres:///anyblok'])
+
+    def test_get_statements(self):
+        self.assertEqual(
+            get_statements('PREPARE a (int) AS SELECT 1, $1\n\n SELECT 2 '),
+            ['PREPARE a (int) AS SELECT 1, $1', 'SELECT 2'])
+        self.assertEqual(get_statements(['SELECT 1']), ['SELECT 1'])
+
+    def test_prewarm_sql_from_string(self):
+        Configuration.add_argument('db_prewarm_sql', None, type=get_statements)
+        Configuration.set('db_prewarm_sql', 'SELECT 1\nSELECT 2')
+        self.assertEqual(Configuration.get('db_prewarm_sql'),
+                         ['SELECT 1', 'SELECT 2'])
+
 
 class TestConfigurationOption(TestCase):
 
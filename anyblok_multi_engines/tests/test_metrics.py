@@ -0,0 +1,121 @@
+# This file is a part of the AnyBlok project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase
+from anyblok_multi_engines.metrics import Metrics, format_labels
+from anyblok_multi_engines.monitor import HealthChecker
+from anyblok_multi_engines.breaker import CircuitBreaker
+from anyblok_multi_engines.cache import QueryCache
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+
+class MockRegistry:
+
+    db_name = 'test'
+    lag_monitor = None
+    circuit_breaker = None
+    query_cache = None
+
+    def __init__(self):
+        self.master = create_engine('sqlite://', poolclass=QueuePool)
+        self.replica = create_engine('sqlite://', poolclass=QueuePool)
+        self.engines = {'ro': [self.replica], 'wo': self.master}
+        self.health_checker = HealthChecker(self, 10, 1)
+
+    def get_engines(self):
+        return [self.replica, self.master]
+
+    def get_all_ro_engines(self):
+        return [self.replica]
+
+    def get_engine_name(self, engine):
+        return 'master' if engine is self.master else 'replica'
+
+
+class TestMetrics(TestCase):
+
+    def test_format_labels(self):
+        self.assertEqual(format_labels(()), '')
+        self.assertEqual(format_labels((('engine', 'a"b'), ('role', 'ro'))),
+                         '{engine="a\\"b",role="ro"}')
+
+    def test_routed(self):
+        registry = MockRegistry()
+        metrics = Metrics(registry)
+        metrics.routed(registry.replica, 'ro', 0.5)
+        metrics.routed(registry.replica, 'ro', 0.5)
+        metrics.routed(registry.master, 'wo', 1)
+        exposition = metrics.exposition()
+        self.assertIn(
+            'anyblok_multi_engines_routed_total{engine="replica",role="ro"} 2',
+            exposition)
+        self.assertIn(
+            'anyblok_multi_engines_routed_total{engine="master",role="wo"} 1',
+            exposition)
+        self.assertIn('anyblok_multi_engines_routing_seconds_sum 2.0',
+                      exposition)
+        self.assertIn('anyblok_multi_engines_routing_seconds_count 3',
+                      exposition)
+
+    def test_routed_callback(self):
+        registry = MockRegistry()
+        calls = []
+        metrics = Metrics(registry, callback=lambda *a: calls.append(a))
+        metrics.routed(registry.replica, 'ro', 0.5)
+        self.assertEqual(calls, [('replica', 'ro', 0.5)])
+
+    def test_waited(self):
+        registry = MockRegistry()
+        metrics = Metrics(registry)
+        metrics.waited(registry.master, 0.25)
+        exposition = metrics.exposition()
+        self.assertIn(
+            'anyblok_multi_engines_pool_wait_seconds_sum{engine="master"} 0.25',
+            exposition)
+        self.assertIn(
+            'anyblok_multi_engines_pool_wait_seconds_count{engine="master"} 1',
+            exposition)
+
+    def test_pools_and_health(self):
+        registry = MockRegistry()
+        registry.health_checker.unhealthy.add(registry.replica)
+        metrics = Metrics(registry)
+        conn = registry.master.connect()
+        try:
+            exposition = metrics.exposition()
+        finally:
+            conn.close()
+
+        self.assertIn(
+            'anyblok_multi_engines_pool_checkedout{engine="master"} 1',
+            exposition)
+        self.assertIn(
+            'anyblok_multi_engines_engine_healthy{engine="replica"} 0',
+            exposition)
+        self.assertNotIn(
+            'anyblok_multi_engines_engine_healthy{engine="master"}',
+            exposition)
+
+    def test_circuit_open(self):
+        registry = MockRegistry()
+        registry.circuit_breaker = CircuitBreaker(1, 10, 30)
+        registry.circuit_breaker.failure(registry.replica)
+        exposition = Metrics(registry).exposition()
+        self.assertIn(
+            'anyblok_multi_engines_engine_circuit_open{engine="replica"} 1',
+            exposition)
+
+    def test_query_cache(self):
+        registry = MockRegistry()
+        registry.query_cache = QueryCache(10, 60)
+        registry.query_cache.get('key')
+        exposition = Metrics(registry).exposition()
+        self.assertIn('anyblok_multi_engines_query_cache_hits_total 0',
+                      exposition)
+        self.assertIn('anyblok_multi_engines_query_cache_misses_total 1',
+                      exposition)
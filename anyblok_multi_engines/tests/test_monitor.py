@@ -0,0 +1,192 @@
+# This file is a part of the AnyBlok project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase
+from anyblok_multi_engines.monitor import (
+    HealthChecker, LagMonitor, parse_lsn, get_current_lsn, get_replay_lsn)
+from anyblok_multi_engines.shared import SHARED_ENGINES
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import OperationalError
+from threading import Event
+
+
+class MockBrokenEngine:
+
+    broken = True
+    disposed = False
+
+    def connect(self):
+        if self.broken:
+            raise OperationalError('SELECT 1', {}, Exception('down'))
+
+        return create_engine('sqlite://').connect()
+
+    def dispose(self):
+        self.disposed = True
+
+
+class MockHangingEngine:
+
+    def __init__(self):
+        self.released = Event()
+        self.connections = 0
+
+    def connect(self):
+        self.connections += 1
+        self.released.wait(5)
+        raise OperationalError('SELECT 1', {}, Exception('timeout'))
+
+    def dispose(self):
+        pass
+
+
+class MockFailingHealthChecker(HealthChecker):
+
+    def check(self, engine):
+        raise OperationalError('SELECT 1', {}, Exception('down'))
+
+
+class MockRegistry:
+
+    db_name = 'test'
+
+    def __init__(self, *engines):
+        self.engines = {'ro': list(engines), 'wo': None}
+
+    def get_all_ro_engines(self):
+        return self.engines['ro']
+
+
+class TestHealthChecker(TestCase):
+
+    def test_healthy(self):
+        engine = create_engine('sqlite://')
+        checker = HealthChecker(MockRegistry(engine), 10, 1)
+        checker.check_engines()
+        self.assertTrue(checker.is_healthy(engine))
+
+    def test_eject(self):
+        engine = MockBrokenEngine()
+        checker = HealthChecker(MockRegistry(engine), 10, 1)
+        checker.check_engines()
+        self.assertFalse(checker.is_healthy(engine))
+        self.assertTrue(engine.disposed)
+
+    def test_eject_shared_engine(self):
+        engine1 = SHARED_ENGINES.acquire(make_url('sqlite://'), 'ro')
+        engine2 = SHARED_ENGINES.acquire(make_url('sqlite://'), 'ro')
+        try:
+            pool = engine2.pool
+            checker = MockFailingHealthChecker(MockRegistry(engine1), 10, 1)
+            checker.check_engines()
+            self.assertFalse(checker.is_healthy(engine1))
+            # the pool is used by the other registry
+            self.assertIs(engine2.pool, pool)
+        finally:
+            SHARED_ENGINES.release(engine1)
+            SHARED_ENGINES.release(engine2)
+
+    def test_reinstate_after_rise(self):
+        engine = MockBrokenEngine()
+        checker = HealthChecker(MockRegistry(engine), 10, 1, rise=2)
+        checker.check_engines()
+        engine.broken = False
+        checker.check_engines()
+        self.assertFalse(checker.is_healthy(engine))
+        checker.check_engines()
+        self.assertTrue(checker.is_healthy(engine))
+
+    def test_reinstate_need_consecutive_successes(self):
+        engine = MockBrokenEngine()
+        checker = HealthChecker(MockRegistry(engine), 10, 1, rise=2)
+        checker.check_engines()
+        engine.broken = False
+        checker.check_engines()
+        engine.broken = True
+        checker.check_engines()
+        engine.broken = False
+        checker.check_engines()
+        self.assertFalse(checker.is_healthy(engine))
+
+    def test_hanging_check(self):
+        hanging = MockHangingEngine()
+        engine1 = create_engine('sqlite://')
+        engine2 = create_engine('sqlite://')
+        checker = HealthChecker(
+            MockRegistry(hanging, engine1, engine2), 10, 0.05)
+        try:
+            for x in range(4):
+                checker.check_engines()
+
+            self.assertEqual(checker.unhealthy, {hanging})
+            self.assertEqual(hanging.connections, 1)
+        finally:
+            hanging.released.set()
+
+    def test_start_and_stop(self):
+        checker = HealthChecker(MockRegistry(create_engine('sqlite://')),
+                                0.01, 1)
+        checker.start()
+        checker.stop()
+        checker.join(1)
+        self.assertFalse(checker.is_alive())
+
+
+class MockLagMonitor(LagMonitor):
+
+    lag = None
+
+    def check(self, engine):
+        if isinstance(self.lag, Exception):
+            raise self.lag
+
+        return self.lag
+
+
+class TestLagMonitor(TestCase):
+
+    def test_unknown_lag_for_sqlite(self):
+        engine = create_engine('sqlite://')
+        monitor = LagMonitor(MockRegistry(engine), 10, 1, 5)
+        monitor.check_engines()
+        self.assertIsNone(monitor.lags[engine])
+        self.assertFalse(monitor.is_lagging(engine))
+
+    def test_lagging(self):
+        engine = create_engine('sqlite://')
+        monitor = MockLagMonitor(MockRegistry(engine), 10, 1, 5)
+        monitor.lag = 10.
+        monitor.check_engines()
+        self.assertTrue(monitor.is_lagging(engine))
+        monitor.lag = 1.
+        monitor.check_engines()
+        self.assertFalse(monitor.is_lagging(engine))
+
+    def test_failed_check(self):
+        engine = create_engine('sqlite://')
+        monitor = MockLagMonitor(MockRegistry(engine), 10, 1, 5)
+        monitor.lag = 10.
+        monitor.check_engines()
+        monitor.lag = Exception('down')
+        monitor.check_engines()
+        self.assertNotIn(engine, monitor.lags)
+        self.assertFalse(monitor.is_lagging(engine))
+
+
+class TestLSN(TestCase):
+
+    def test_parse_lsn(self):
+        self.assertIsNone(parse_lsn(None))
+        self.assertEqual(parse_lsn('0/16B3748'), 0x16B3748)
+        self.assertEqual(parse_lsn('16/B374D848'), (0x16 << 32) + 0xB374D848)
+        self.assertGreater(parse_lsn('1/0'), parse_lsn('0/FFFFFFFF'))
+
+    def test_unknown_lsn_for_sqlite(self):
+        engine = create_engine('sqlite://')
+        self.assertIsNone(get_current_lsn(engine))
+        self.assertIsNone(get_replay_lsn(engine))
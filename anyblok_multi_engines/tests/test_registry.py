@@ -8,8 +8,19 @@
 from anyblok.tests.testcase import DBTestCase, LogCapture
 from anyblok.config import Configuration
 from anyblok_multi_engines.registry import RegistryMultiEngines as Registry
+from anyblok_multi_engines.balancer import RoundRobinBalancer
+from anyblok_multi_engines.monitor import HealthChecker, LagMonitor
+from anyblok_multi_engines.breaker import CircuitBreaker
+from anyblok_multi_engines.shared import SHARED_ENGINES
 from anyblok.registry import RegistryException
+from anyblok.environment import EnvironmentManager
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import SingletonThreadPool
 from logging import DEBUG
+from time import sleep
+from threading import Event
+from unittest.mock import patch
 
 
 class TestRegistry(DBTestCase):
@@ -45,6 +56,134 @@ class TestRegistry(DBTestCase):
             engine = registry.get_engine_for()
             self.assertIn(engine, registry.engines['ro'])
 
+    def test_get_engine_ro_with_balancer(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///?weight=2', 'postgresql:///'],
+            db_url='', db_wo_url='', db_ro_balancer='round-robin'
+        ):
+            registry = self.get_registry()
+            self.assertIsInstance(registry.balancer, RoundRobinBalancer)
+            engine1, engine2 = registry.engines['ro']
+            self.assertEqual(registry.get_engine_options(engine1),
+                             {'weight': 2.})
+            self.assertEqual(registry.get_engine_options(engine2), {})
+            self.assertIsNot(registry.get_engine_for(),
+                             registry.get_engine_for())
+
+    def test_get_engine_ro_with_ewma_balancer(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///'], db_url='',
+            db_wo_url='postgresql:///', db_ro_balancer='ewma'
+        ):
+            registry = self.get_registry(unittest=False)
+            registry.System.Blok.query().all()
+            self.assertIn(registry.engines['ro'][0],
+                          registry.balancer.latencies)
+
+    def test_get_engine_ro_with_health_checker(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///'], db_url='',
+            db_wo_url='postgresql:///', db_ro_health_check_interval=60
+        ):
+            registry = self.get_registry()
+            self.assertIsInstance(registry.health_checker, HealthChecker)
+            self.assertTrue(registry.health_checker.is_alive())
+            engine = registry.engines['ro'][0]
+            self.assertIs(registry.get_engine_for(), engine)
+            registry.health_checker.unhealthy.add(engine)
+            self.assertIs(registry.get_engine_for(), registry.engines['wo'])
+            registry.close()
+            self._registry = None
+            self.assertTrue(registry.health_checker.stopped.is_set())
+
+    def test_get_engine_ro_with_lag_monitor(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///'], db_url='',
+            db_wo_url='postgresql:///', db_ro_max_lag=10
+        ):
+            registry = self.get_registry()
+            self.assertIsInstance(registry.lag_monitor, LagMonitor)
+            engine = registry.engines['ro'][0]
+            registry.lag_monitor.check_engines()
+            self.assertEqual(registry.lag_monitor.lags[engine], 0)
+            self.assertIs(registry.get_engine_for(), engine)
+            registry.lag_monitor.lags[engine] = 60
+            self.assertIs(registry.get_engine_for(), registry.engines['wo'])
+
+    def test_get_engine_ro_with_circuit_breaker(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///', 'postgresql:///'], db_url='',
+            db_wo_url='postgresql:///', db_ro_breaker_errors=1
+        ):
+            registry = self.get_registry()
+            self.assertIsInstance(registry.circuit_breaker, CircuitBreaker)
+            engine1, engine2 = registry.engines['ro']
+            registry.circuit_breaker.failure(engine1)
+            for x in range(10):
+                self.assertIs(registry.get_engine_for(), engine2)
+
+    def test_get_engine_ro_with_zone(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///?zone=a', 'postgresql:///?zone=b',
+                        'postgresql:///'],
+            db_url='', db_wo_url='postgresql:///', db_zone='b',
+            db_ro_breaker_errors=1
+        ):
+            registry = self.get_registry()
+            engine1, engine2, engine3 = registry.engines['ro']
+            for x in range(10):
+                self.assertIs(registry.get_engine_for(), engine2)
+
+            registry.circuit_breaker.failure(engine2)
+            for x in range(10):
+                self.assertIn(registry.get_engine_for(), (engine1, engine3))
+
+    def test_prewarm_engines(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///?pool_size=2'], db_url='',
+            db_wo_url='postgresql:///?pool_size=5', db_prewarm_connections=3,
+            db_prewarm_sql=['SELECT 1']
+        ):
+            registry = self.get_registry()
+            self.assertEqual(registry.engines['ro'][0].pool.checkedin(), 2)
+            self.assertGreaterEqual(registry.engines['wo'].pool.checkedin(),
+                                    2)
+
+    def test_prewarm_engines_with_singleton_thread_pool(self):
+
+        class SingletonRegistry(Registry):
+
+            def init_engine_options(self):
+                return dict(poolclass=SingletonThreadPool)
+
+        with DBTestCase.Configuration(db_prewarm_connections=2):
+            self._registry = SingletonRegistry(Configuration.get('db_name'),
+                                               unittest=True)
+            self.assertIsInstance(self._registry.engines['wo'].pool,
+                                  SingletonThreadPool)
+
+    def test_prewarm_engines_with_error(self):
+        with DBTestCase.Configuration(
+            db_prewarm_connections=2, db_prewarm_sql=['SELECT unknown']
+        ):
+            with LogCapture('anyblok_multi_engines.registry') as logs:
+                self.get_registry()
+
+            self.assertTrue(logs.get_warning_messages())
+
+    def test_pool_options_by_role(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///?pool_size=30', 'postgresql:///'],
+            db_url='', db_wo_url='postgresql:///', db_ro_pool_size=20,
+            db_wo_pool_size=3, db_wo_max_overflow=1
+        ):
+            registry = self.get_registry()
+            engine1, engine2 = registry.engines['ro']
+            self.assertEqual(engine1.pool.size(), 30)
+            self.assertEqual(engine2.pool.size(), 20)
+            self.assertEqual(registry.engines['wo'].pool.size(), 3)
+            self.assertEqual(registry.engines['wo'].pool._max_overflow, 1)
+
     def test_get_engine_ro_without_r(self):
         with DBTestCase.Configuration(
             db_ro_urls=[], db_url='', db_wo_url='postgresql:///'
@@ -112,6 +251,503 @@ class TestRegistry(DBTestCase):
             self.assertIn(registry.engine, registry.engines['ro'])
             self.assertIsNot(registry.engine, registry.engines['wo'])
 
+    def test_sticky_after_write(self):
+        with DBTestCase.Configuration(db_sticky_after_write=True):
+            registry = self.get_registry()
+            session = registry.session
+            self.assertFalse(session.must_read_on_master())
+            session.wrote_on_master = True
+            self.assertTrue(session.must_read_on_master())
+            session.end_of_transaction()
+            self.assertFalse(session.wrote_on_master)
+            self.assertFalse(session.must_read_on_master())
+
+    def test_sticky_after_write_with_window(self):
+        with DBTestCase.Configuration(db_sticky_after_write=True,
+                                      db_sticky_window=60):
+            registry = self.get_registry()
+            session = registry.session
+            session.wrote_on_master = True
+            session.end_of_transaction()
+            self.assertTrue(session.must_read_on_master())
+            EnvironmentManager.set('_sticky_master_until', 0)
+            self.assertFalse(session.must_read_on_master())
+
+    def test_without_sticky_after_write(self):
+        registry = self.get_registry()
+        session = registry.session
+        session.wrote_on_master = True
+        self.assertFalse(session.must_read_on_master())
+
+    def test_read_your_writes(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///', 'postgresql:///'], db_url='',
+            db_wo_url='postgresql:///', db_read_your_writes=True,
+            db_ro_lsn_wait=0
+        ):
+            registry = self.get_registry()
+            master = registry.engines['wo']
+            engine1, engine2 = registry.engines['ro']
+            registry.replay_lsns.update({engine1: 99, engine2: 100})
+            try:
+                EnvironmentManager.set('_write_positions', {master: 100})
+                for x in range(10):
+                    self.assertIs(registry.get_engine_for(), engine2)
+
+                EnvironmentManager.set('_write_positions', {master: 101})
+                self.assertIs(registry.get_engine_for(), master)
+            finally:
+                EnvironmentManager.set('_write_positions', None)
+
+    def test_read_your_writes_save_position_at_commit(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///'], db_url='',
+            db_wo_url='postgresql:///', db_read_your_writes=True
+        ):
+            registry = self.get_registry(unittest=False)
+            master = registry.engines['wo']
+            try:
+                blok = registry.System.Blok.query().first()
+                blok.short_description = 'Read your writes'
+                registry.flush()
+                self.assertEqual(registry.session.written_engines, {master})
+                registry.rollback()
+                self.assertIsNone(EnvironmentManager.get('_write_positions'))
+                registry.save_write_positions([master])
+                self.assertIsInstance(
+                    EnvironmentManager.get('_write_positions')[master], int)
+            finally:
+                EnvironmentManager.set('_write_positions', None)
+
+    def test_session_affinity(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///', 'postgresql:///'], db_url='',
+            db_wo_url='postgresql:///', db_ro_session_affinity=True
+        ):
+            registry = self.get_registry()
+            session = registry.session
+            engine = session.get_ro_engine()
+            self.assertIn(engine, registry.engines['ro'])
+            for x in range(10):
+                self.assertIs(session.get_ro_engine(), engine)
+
+            self.assertEqual(session.ro_engines, {None: engine})
+            session.end_of_transaction()
+            self.assertIsNone(session.ro_engines)
+
+    def test_without_session_affinity(self):
+        registry = self.get_registry()
+        session = registry.session
+        session.get_ro_engine()
+        self.assertIsNone(session.ro_engines)
+
+    def test_exclude_engine(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///', 'postgresql:///'], db_url='',
+            db_wo_url='postgresql:///'
+        ):
+            registry = self.get_registry()
+            engine1, engine2 = registry.engines['ro']
+            session = registry.session
+            session.exclude_engine(engine1)
+            for x in range(10):
+                self.assertIs(session.get_ro_engine(), engine2)
+
+            session.exclude_engine(engine2)
+            self.assertIs(session.get_ro_engine(), registry.engines['wo'])
+            session.end_of_transaction()
+            self.assertIsNone(session.excluded_engines)
+
+    def test_retry_read_on_another_engine(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql://localhost:1/'], db_url='',
+            db_wo_url='postgresql:///', db_ro_retries=1,
+            db_ro_retry_backoff=0
+        ):
+            registry = self.get_registry(unittest=False)
+            registry.rollback()
+
+            @event.listens_for(registry.engines['ro'][0], 'handle_error')
+            def lost_connection(context):
+                context.is_disconnect = True
+
+            self.assertTrue(registry.session.can_retry_read())
+            self.assertTrue(registry.System.Blok.query().all())
+            self.assertEqual(registry.session.excluded_engines,
+                             set(registry.engines['ro']))
+
+    def test_no_retry_read_without_lost_connection(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql://localhost:1/'], db_url='',
+            db_wo_url='postgresql:///', db_ro_retries=1,
+            db_ro_retry_backoff=0
+        ):
+            registry = self.get_registry(unittest=False)
+            registry.rollback()
+            with self.assertRaises(OperationalError):
+                registry.System.Blok.query().all()
+
+            self.assertIsNone(registry.session.excluded_engines)
+
+    def test_share_engines(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///', 'postgresql:///'], db_url='',
+            db_wo_url='postgresql:///', db_share_engines=True
+        ):
+            registry = self.get_registry()
+            engine1, engine2 = registry.engines['ro']
+            self.assertIsNot(engine1, engine2)
+            self.assertIs(engine1.pool, engine2.pool)
+            self.assertIsNot(engine1.pool, registry.engines['wo'].pool)
+            self.assertTrue(SHARED_ENGINES.is_shared(engine1))
+            registry.close()
+            self._registry = None
+            self.assertFalse(SHARED_ENGINES.is_shared(engine1))
+
+    def test_get_engine_by_name(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///?name=reporting', 'postgresql:///'],
+            db_url='', db_wo_url='postgresql:///'
+        ):
+            registry = self.get_registry()
+            self.assertIs(registry.get_engine_by_name('reporting'),
+                          registry.engines['ro'][0])
+            with self.assertRaises(RegistryException):
+                registry.get_engine_by_name('unknown')
+
+    def test_using(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///?name=reporting', 'postgresql:///'],
+            db_url='', db_wo_url='postgresql:///'
+        ):
+            registry = self.get_registry()
+            session = registry.session
+            with registry.using('master'):
+                self.assertIs(session.get_engine_for_routing(),
+                              registry.engines['wo'])
+                with registry.using('reporting'):
+                    self.assertIs(session.get_engine_for_routing(),
+                                  registry.engines['ro'][0])
+
+                with registry.using('replica'):
+                    self.assertIn(session.get_engine_for_routing(),
+                                  registry.engines['ro'])
+
+                self.assertEqual(session.routing, 'master')
+
+            self.assertIsNone(session.routing)
+
+    def test_query_on_master_and_on_replica(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///?name=reporting'], db_url='',
+            db_wo_url='postgresql:///'
+        ):
+            registry = self.get_registry()
+            query = registry.System.Blok.query()
+            self.assertIsNone(query.routing)
+            self.assertEqual(query.on_master().routing, 'master')
+            self.assertEqual(query.on_replica().routing, 'replica')
+            self.assertEqual(query.on_replica('reporting').routing,
+                             'reporting')
+            self.assertTrue(query.on_master().all())
+            self.assertTrue(query.on_replica('reporting').count())
+
+    def test_get_engines(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///?name=reporting'],
+            db_url='postgresql:///', db_wo_url=''
+        ):
+            registry = self.get_registry()
+            self.assertEqual(registry.get_engines(), registry.engines['ro'])
+            self.assertEqual(
+                registry.get_engine_name(registry.engines['ro'][0]),
+                'reporting')
+            self.assertEqual(
+                registry.get_engine_name(registry.engines['wo']),
+                repr(registry.engines['wo'].url))
+
+    def test_metrics(self):
+        with DBTestCase.Configuration(db_metrics=True):
+            registry = self.get_registry(unittest=False)
+            registry.System.Blok.query().all()
+            exposition = registry.metrics.exposition()
+            self.assertIn('anyblok_multi_engines_routed_total', exposition)
+            self.assertIn('anyblok_multi_engines_pool_wait_seconds_count',
+                          exposition)
+
+    def test_metrics_dml_on_master(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///?name=replica'], db_url='',
+            db_wo_url='postgresql:///?name=master', db_metrics=True
+        ):
+            registry = self.get_registry(unittest=False)
+            registry.System.Blok.query().filter_by(name='unknown').update(
+                {'short_description': 'DML'}, synchronize_session=False)
+            self.assertIn(
+                'anyblok_multi_engines_routed_total'
+                '{engine="master",role="wo"} 1', registry.metrics.exposition())
+
+    def test_metrics_pool_wait_by_checkout(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///?name=replica'], db_url='',
+            db_wo_url='postgresql:///', db_metrics=True
+        ):
+            registry = self.get_registry(unittest=False)
+            for x in range(10):
+                registry.System.Blok.query().all()
+
+            self.assertIn(
+                'anyblok_multi_engines_pool_wait_seconds_count'
+                '{engine="replica"} 1', registry.metrics.exposition())
+
+    def test_without_metrics(self):
+        registry = self.get_registry()
+        self.assertIsNone(registry.metrics)
+
+    def test_fanout(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///', 'postgresql:///'], db_url='',
+            db_wo_url='postgresql:///'
+        ):
+            registry = self.get_registry()
+            results = list(registry.fanout(
+                'SELECT count(*) FROM system_blok WHERE name = :name',
+                params={'name': 'anyblok-core'}))
+            self.assertEqual(
+                sorted(results, key=lambda x: registry.engines['ro'].index(
+                    x[0])),
+                [(engine, [(1,)], None) for engine in registry.engines['ro']])
+
+    def test_fanout_with_error_and_timeout(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///'], db_url='',
+            db_wo_url='postgresql:///'
+        ):
+            registry = self.get_registry()
+            (engine, result, error), = registry.fanout('SELECT unknown')
+            self.assertIsNotNone(error)
+            (engine, result, error), = registry.fanout(
+                lambda connection: connection.execute('SELECT pg_sleep(1)'),
+                timeout=0.1)
+            self.assertIsInstance(error, TimeoutError)
+
+    def test_fanout_after_timeouts(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///', 'postgresql:///'], db_url='',
+            db_wo_url='postgresql:///'
+        ):
+            registry = self.get_registry()
+            for x in range(2):
+                for engine, result, error in registry.fanout(
+                    lambda connection: sleep(1), timeout=0.1
+                ):
+                    self.assertIsInstance(error, TimeoutError)
+
+            self.assertEqual(registry.fanout_merge('SELECT 1', timeout=0.1),
+                             [(1,), (1,)])
+
+    def test_fanout_statement_timeout(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///'], db_url='',
+            db_wo_url='postgresql:///'
+        ):
+            registry = self.get_registry()
+            (engine, result, error), = registry.fanout(
+                lambda connection: connection.execute(
+                    'SHOW statement_timeout').scalar(), timeout=2)
+            self.assertEqual(result, '2s')
+
+    def test_fanout_merge(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///', 'postgresql:///'], db_url='',
+            db_wo_url='postgresql:///'
+        ):
+            registry = self.get_registry()
+            self.assertEqual(registry.fanout_merge('SELECT 1'), [(1,), (1,)])
+            with self.assertRaises(Exception):
+                registry.fanout_merge('SELECT unknown')
+
+    def test_query_cache(self):
+        with DBTestCase.Configuration(db_query_cache_size=10):
+            registry = self.get_registry(unittest=False)
+            Blok = registry.System.Blok
+            query = Blok.query().filter_by(name='anyblok-core').cached()
+            blok = query.one()
+            self.assertEqual(registry.query_cache.misses, 1)
+            self.assertIs(query.one(), blok)
+            self.assertEqual(registry.query_cache.hits, 1)
+            blok.short_description = 'Query cache'
+            registry.flush()
+            self.assertEqual(registry.query_cache.entries, {})
+            registry.rollback()
+            Blok.query().filter_by(name='anyblok-core').one()
+            self.assertEqual(registry.query_cache.misses, 1)
+
+    def test_without_query_cache(self):
+        registry = self.get_registry()
+        self.assertIsNone(registry.query_cache)
+        self.assertTrue(registry.System.Blok.query().cached().all())
+
+    def test_get_bulk_engine(self):
+        with DBTestCase.Configuration(
+            db_bulk_pool_size=2, db_bulk_statement_timeout=60,
+            db_bulk_synchronous_commit='off'
+        ):
+            registry = self.get_registry()
+            engine = registry.get_bulk_engine()
+            self.assertIs(registry.get_bulk_engine(), engine)
+            self.assertIsNot(engine, registry.engines['wo'])
+            self.assertEqual(engine.url, registry.engines['wo'].url)
+            self.assertEqual(engine.pool.size(), 2)
+            conn = engine.connect()
+            try:
+                self.assertEqual(
+                    conn.execute('SHOW statement_timeout').scalar(), '1min')
+                self.assertEqual(
+                    conn.execute('SHOW synchronous_commit').scalar(), 'off')
+            finally:
+                conn.close()
+
+    def test_bulk_write(self):
+        registry = self.get_registry(unittest=False)
+        registry.rollback()
+        Blok = registry.System.Blok
+        with self.assertRaises(ZeroDivisionError):
+            with registry.bulk_write():
+                self.assertIs(
+                    registry.session.get_bind(mapper=Blok.__mapper__),
+                    registry.get_bulk_engine())
+                1 / 0
+
+        self.assertIsNone(registry.session.routing)
+
+    def test_bulk_write_in_transaction(self):
+        registry = self.get_registry(unittest=False)
+        registry.System.Blok.query().all()
+        with self.assertRaises(RegistryException):
+            with registry.bulk_write():
+                pass  # pragma: no cover
+
+    def test_dml_on_master(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///'], db_url='', db_wo_url='postgresql:///'
+        ):
+            registry = self.get_registry(unittest=False)
+            table = registry.System.Blok.__table__
+            self.assertIs(registry.session.get_bind(clause=table.update()),
+                          registry.engines['wo'])
+            self.assertIs(registry.session.get_bind(clause=table.select()),
+                          registry.engines['ro'][0])
+
+    def test_read_only(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=['postgresql:///'], db_url='', db_wo_url=''
+        ):
+            registry = self.get_registry(unittest=False)
+            self.assertTrue(registry.read_only)
+            self.assertFalse(registry.Session.session_factory.kw['autoflush'])
+            self.assertEqual(
+                registry.execute('SHOW transaction_read_only').scalar(), 'on')
+            Blok = registry.System.Blok
+            blok = Blok.query().filter_by(name='anyblok-core').one()
+            blok.short_description = 'Read only'
+            with self.assertRaises(RegistryException):
+                registry.flush()
+
+            registry.rollback()
+            with self.assertRaises(RegistryException):
+                Blok.query().update({'short_description': 'Read only'})
+
+    def test_read_only_with_db_url(self):
+        with DBTestCase.Configuration(
+            db_ro_urls=[], db_url='postgresql:///', db_wo_url='',
+            db_read_only=True
+        ):
+            registry = self.get_registry(unittest=False)
+            self.assertTrue(registry.read_only)
+            self.assertIsNone(registry.engines['wo'])
+            self.assertEqual(len(registry.engines['ro']), 1)
+            self.assertTrue(registry.System.Blok.query().count())
+
+    def test_engine_groups(self):
+        with DBTestCase.Configuration(
+            db_group_wo_urls=['shard1=postgresql:///'],
+            db_group_ro_urls=['shard2=postgresql:///?name=shard2-ro'],
+            db_group_models=['Model.System.Blok=shard1']
+        ):
+            registry = self.get_registry()
+            shard1 = registry.engine_groups['shard1']
+            shard2 = registry.engine_groups['shard2']
+            self.assertIsNotNone(shard1['wo'])
+            self.assertEqual(shard1['ro'], [shard1['wo']])
+            self.assertIs(shard2['wo'], registry.engines['wo'])
+            self.assertEqual(shard2['ro'],
+                             [registry.get_engine_by_name('shard2-ro')])
+            self.assertIs(registry.get_engine_for(ro=False, group='shard1'),
+                          shard1['wo'])
+            self.assertIs(registry.get_engine_for(group='shard2'),
+                          shard2['ro'][0])
+            self.assertIn(shard1['wo'], registry.get_engines())
+            self.assertIn(shard2['ro'][0], registry.get_all_ro_engines())
+            with self.assertRaises(RegistryException):
+                registry.get_engine_for(group='unknown')
+
+    def test_get_engine_group(self):
+        with DBTestCase.Configuration(
+            db_group_wo_urls=['shard1=postgresql:///',
+                              'shard2=postgresql:///'],
+            db_group_models=['Model.System.Blok=shard1']
+        ):
+            registry = self.get_registry()
+            blok_mapper = registry.System.Blok.__mapper__
+            model_mapper = registry.System.Model.__mapper__
+            self.assertIsNone(registry.get_engine_group())
+            self.assertEqual(registry.get_engine_group(blok_mapper), 'shard1')
+            self.assertEqual(registry.get_engine_group(registry.System.Blok),
+                             'shard1')
+            self.assertIsNone(registry.get_engine_group(model_mapper))
+            with registry.using_group('shard2'):
+                self.assertEqual(registry.get_engine_group(blok_mapper),
+                                 'shard1')
+                self.assertEqual(registry.get_engine_group(model_mapper),
+                                 'shard2')
+
+            self.assertIsNone(registry.get_engine_group(model_mapper))
+            with self.assertRaises(RegistryException):
+                with registry.using_group('unknown'):
+                    pass
+
+    def test_get_engine_group_by_model_attribute(self):
+        with DBTestCase.Configuration(
+            db_group_ro_urls=['reporting=postgresql:///'],
+            db_group_wo_urls=['archive=postgresql:///'],
+            db_group_models=['Model.System.Model=archive']
+        ):
+            registry = self.get_registry()
+            blok_mapper = registry.System.Blok.__mapper__
+            model_mapper = registry.System.Model.__mapper__
+            registry.System.Blok.__engine_group__ = 'reporting'
+            registry.System.Model.__engine_group__ = 'reporting'
+            try:
+                self.assertEqual(registry.get_engine_group(blok_mapper),
+                                 'reporting')
+                self.assertEqual(registry.get_engine_group(model_mapper),
+                                 'archive')
+                self.assertIs(
+                    registry.session.get_bind(mapper=blok_mapper),
+                    registry.engine_groups['reporting']['ro'][0])
+            finally:
+                del registry.System.Blok.__engine_group__
+                del registry.System.Model.__engine_group__
+
+    def test_engine_groups_with_two_masters(self):
+        with DBTestCase.Configuration(
+            db_group_wo_urls=['shard1=postgresql:///',
+                              'shard1=postgresql:///'],
+        ):
+            with self.assertRaises(RegistryException):
+                self.get_registry()
+
     def test_db_url_and_db_wo_url(self):
         with DBTestCase.Configuration(
             db_ro_urls=[], db_url='postgresql:///', db_wo_url='postgresql:///'
@@ -162,6 +798,19 @@ class TestRegistry(DBTestCase):
         ):
             self.assertTrue(Registry.db_exists(db_name=db_name))
 
+    def test_db_exists_with_timeout(self):
+        db_name = Configuration.get('db_name')
+        Registry = Configuration.get('Registry')
+        released = Event()
+        with DBTestCase.Configuration(db_exists_timeout=0.1):
+            with patch('anyblok_multi_engines.registry.database_exists',
+                       side_effect=lambda url: released.wait(5)):
+                try:
+                    with self.assertRaises(RegistryException):
+                        Registry.db_exists(db_name=db_name)
+                finally:
+                    released.set()
+
     def test_db_exists_without_db_name(self):
         Registry = Configuration.get('Registry')
         with self.assertRaises(RegistryException):
@@ -0,0 +1,93 @@
+# This file is a part of the AnyBlok project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase
+from anyblok_multi_engines.shared import SharedEngines, execute_on_connect
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+
+
+class TestSharedEngines(TestCase):
+
+    def test_acquire_same_url(self):
+        shared = SharedEngines()
+        url = make_url('sqlite:///test.db')
+        engine1 = shared.acquire(url, 'ro')
+        engine2 = shared.acquire(make_url('sqlite:///test.db'), 'ro')
+        self.assertIsNot(engine1, engine2)
+        self.assertIs(engine1.pool, engine2.pool)
+        self.assertTrue(shared.is_shared(engine1))
+        self.assertEqual(len(shared.engines), 1)
+        shared.release(engine1)
+        self.assertEqual(len(shared.engines), 1)
+        shared.release(engine2)
+        self.assertEqual(shared.engines, {})
+        self.assertFalse(shared.is_shared(engine2))
+
+    def test_acquire_other_database_role_or_options(self):
+        shared = SharedEngines()
+        engine1 = shared.acquire(make_url('sqlite:///test.db'), 'ro')
+        engine2 = shared.acquire(make_url('sqlite:///other.db'), 'ro')
+        engine3 = shared.acquire(make_url('sqlite:///test.db'), 'wo')
+        engine4 = shared.acquire(make_url('sqlite:///test.db'), 'ro',
+                                 pool_recycle=10)
+        self.assertEqual(len({engine1.pool, engine2.pool, engine3.pool,
+                              engine4.pool}), 4)
+        self.assertEqual(str(engine2.url), 'sqlite:///other.db')
+
+    def test_get_key_without_database(self):
+        shared = SharedEngines()
+        self.assertEqual(
+            shared.get_key(make_url('mysql://user@host/db1'), 'ro', {}),
+            shared.get_key(make_url('mysql://user@host/db2'), 'ro', {}))
+        self.assertNotEqual(
+            shared.get_key(make_url('postgresql://user@host/db1'), 'ro', {}),
+            shared.get_key(make_url('postgresql://user@host/db2'), 'ro', {}))
+
+    def test_get_shared_url_without_database(self):
+        shared = SharedEngines()
+        self.assertIsNone(
+            shared.get_shared_url(make_url('mysql://user@host/db1')).database)
+        self.assertEqual(
+            shared.get_shared_url(
+                make_url('postgresql://user@host/db1')).database, 'db1')
+
+    def test_acquire_with_statements(self):
+        shared = SharedEngines()
+        statements = ['CREATE TABLE test (id INTEGER)']
+        engine1 = shared.acquire(make_url('sqlite://'), 'ro',
+                                 statements=statements)
+        engine2 = shared.acquire(make_url('sqlite://'), 'ro',
+                                 statements=statements)
+        engine3 = shared.acquire(make_url('sqlite://'), 'ro')
+        self.assertIs(engine1.pool, engine2.pool)
+        self.assertIsNot(engine1.pool, engine3.pool)
+        # the table is created only once by connection
+        self.assertEqual(engine2.execute('SELECT count(*) FROM test').scalar(),
+                         0)
+
+    def test_switch_database(self):
+        shared = SharedEngines()
+        engine = create_engine('sqlite://').execution_options()
+        shared.switch_database(engine, 'CREATE TABLE %s (id INTEGER)', 'db1')
+        engine.execute('SELECT * FROM db1')
+        # the statement is executed only once by connection
+        engine.execute('SELECT * FROM db1')
+
+
+class TestExecuteOnConnect(TestCase):
+
+    def test_execute_on_connect(self):
+        engine = create_engine('sqlite://')
+        execute_on_connect(engine, ['CREATE TABLE test (id INTEGER)',
+                                    'INSERT INTO test VALUES (1)'])
+        self.assertEqual(engine.execute('SELECT id FROM test').scalar(), 1)
+
+    def test_execute_on_connect_without_statement(self):
+        engine = create_engine('sqlite://')
+        execute_on_connect(engine, [])
+        self.assertEqual(engine.execute('SELECT 1').scalar(), 1)
@@ -0,0 +1,301 @@
+# This file is a part of the AnyBlok Multi Engines project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Benchmarks of the routing of AnyBlok Multi Engines
+
+SQLite files are used as local stand-ins for the master and the replicas,
+the registry only builds the engines and the session factory, no blok is
+loaded::
+
+    python benchmarks/bench_routing.py
+    python benchmarks/bench_routing.py --save baseline.json
+    python benchmarks/bench_routing.py --compare baseline.json
+
+With ``--compare``, the script exits with the status 1 if one benchmark is
+slower than the baseline by more than ``--tolerance``
+"""
+from anyblok.config import Configuration
+from anyblok.environment import EnvironmentManager
+from anyblok_multi_engines.registry import MultiEngines
+from argparse import ArgumentParser
+from sqlalchemy import Column, Integer, String
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Session, Query
+from sqlalchemy.pool import QueuePool
+from tempfile import TemporaryDirectory
+from timeit import default_timer
+import json
+import os
+import sys
+
+
+NB_REPLICAS = (1, 4, 16)
+BALANCERS = ('random', 'round-robin', 'least-connections',
+             'power-of-two-choices', 'ewma')
+Base = declarative_base()
+
+
+class Bench(Base):
+    __tablename__ = 'bench'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(64))
+
+
+class CoreSession(Session):
+
+    def __init__(self, *args, **kwargs):
+        kwargs['query_cls'] = self.registry_query
+        super(CoreSession, self).__init__(*args, **kwargs)
+
+
+class BenchRegistry(MultiEngines):
+    """Registry with only the engines and the session factory"""
+
+    unittest = False
+    loadwithoutmigration = False
+    withoutautomigration = True
+
+    def __init__(self):
+        self.db_name = None
+        self.additional_setting = {}
+        self.init_engine()
+        self.init_bind()
+        self.Session = None
+        self.nb_query_bases = self.nb_session_bases = 0
+        self.loaded_cores = {'Query': [Query], 'Session': [CoreSession]}
+        self.registry_base = type('RegistryBase', tuple(), {
+            'registry': self, 'Env': EnvironmentManager})
+        self.create_session_factory()
+
+    @property
+    def session(self):
+        return self.Session()
+
+    def init_engine_options(self):
+        return dict(poolclass=QueuePool)
+
+    def apply_session_events(self):
+        pass
+
+    def close(self):
+        self.stop_monitors()
+        self.Session.remove()
+        self.dispose_engines()
+
+
+def get_url(db_name=None, url=None):
+    """get_url plugin which keep the path of the SQLite file"""
+    return make_url(url)
+
+
+def get_registry(directory, nb_replicas, **options):
+    """ Create the SQLite files and return the registry
+
+    :param directory: directory of the SQLite files
+    :param nb_replicas: number of read only engines
+    :param options: other Configuration options
+    """
+    urls = ['sqlite:///%s' % os.path.join(directory, 'replica%d.db' % x)
+            for x in range(nb_replicas)]
+    master = 'sqlite:///%s' % os.path.join(directory, 'master.db')
+    Configuration.configuration.clear()
+    Configuration.add_argument('get_url', get_url, type=None)
+    Configuration.update(db_ro_urls=urls, db_wo_url=master, db_url='',
+                         db_name=None, **options)
+    registry = BenchRegistry()
+    for engine in registry.get_engines():
+        Base.metadata.create_all(engine)
+        engine.execute(Bench.__table__.insert(),
+                       [{'name': 'row %d' % x} for x in range(100)])
+
+    return registry
+
+
+def timed(function, number):
+    """ Return the best time in seconds of one call of the function on
+    three repeats
+    """
+    best = None
+    for repeat in range(3):
+        start = default_timer()
+        for x in range(number):
+            function()
+
+        duration = (default_timer() - start) / number
+        best = duration if best is None else min(best, duration)
+
+    return best
+
+
+def bench_routing(registry, number):
+    session = registry.session
+
+    def route():
+        session.get_bind()
+
+    return timed(route, number)
+
+
+def bench_session_factory(registry, number):
+
+    def create_session_factory():
+        registry.Session = None
+        registry.create_session_factory()
+
+    return timed(create_session_factory, number)
+
+
+def bench_session(registry, number):
+
+    def create_session():
+        registry.Session()
+        registry.Session.remove()
+
+    return timed(create_session, number)
+
+
+def bench_read(registry, number):
+    session = registry.session
+
+    def read():
+        session.query(Bench).filter(Bench.id == 1).one()
+        session.commit()
+
+    return timed(read, number)
+
+
+def bench_read_cached(registry, number):
+    session = registry.session
+
+    def read():
+        session.query(Bench).filter(Bench.id == 1).cached().one()
+        session.commit()
+
+    return timed(read, number)
+
+
+def bench_write(registry, number):
+    session = registry.session
+
+    def write():
+        session.add(Bench(name='bench'))
+        session.commit()
+
+    return timed(write, number)
+
+
+def run(scale=1.):
+    """ Run all the benchmarks
+
+    :param scale: factor of the number of calls
+    :rtype: dict {name: seconds by call}
+    """
+    results = {}
+
+    def number(value):
+        return max(1, int(value * scale))
+
+    with TemporaryDirectory() as directory:
+        for nb_replicas in NB_REPLICAS:
+            registry = get_registry(directory, nb_replicas)
+            try:
+                results['routing_%d' % nb_replicas] = bench_routing(
+                    registry, number(20000))
+                results['read_%d' % nb_replicas] = bench_read(
+                    registry, number(1000))
+                results['write_%d' % nb_replicas] = bench_write(
+                    registry, number(500))
+            finally:
+                registry.close()
+
+        for balancer in BALANCERS:
+            registry = get_registry(directory, NB_REPLICAS[-1],
+                                    db_ro_balancer=balancer)
+            try:
+                results['routing_%d_%s' % (NB_REPLICAS[-1], balancer)] = (
+                    bench_routing(registry, number(20000)))
+            finally:
+                registry.close()
+
+        registry = get_registry(directory, NB_REPLICAS[0],
+                                db_query_cache_size=100)
+        try:
+            results['read_cached'] = bench_read_cached(registry, number(1000))
+        finally:
+            registry.close()
+
+        registry = get_registry(directory, NB_REPLICAS[0])
+        try:
+            results['session_factory'] = bench_session_factory(
+                registry, number(1000))
+            results['session'] = bench_session(registry, number(10000))
+        finally:
+            registry.close()
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Print the results and return the names of the regressions
+
+    :param results: dict {name: seconds by call}
+    :param baseline: dict {name: seconds by call}
+    :param tolerance: allowed slowdown, 0.25 means 25% slower
+    :rtype: list of names
+    """
+    regressions = []
+    print('%-40s %12s %12s %10s' % ('benchmark', 'us/call', 'calls/s',
+                                    'baseline'))
+    for name in sorted(results):
+        duration = results[name]
+        ratio = ''
+        if name in baseline:
+            ratio = duration / baseline[name]
+            if ratio > 1 + tolerance:
+                regressions.append(name)
+
+            ratio = '%.2fx' % ratio
+
+        print('%-40s %12.2f %12.0f %10s' % (
+            name, duration * 1e6, 1 / duration, ratio))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scale', type=float, default=1.,
+                        help="Factor of the number of calls")
+    parser.add_argument('--save', help="Save the results in this json file")
+    parser.add_argument('--compare',
+                        help="Compare with the results of this json file")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="Allowed slowdown compared with the baseline")
+    args = parser.parse_args(argv)
+
+    results = run(scale=args.scale)
+    baseline = {}
+    if args.compare:
+        with open(args.compare, 'r') as fp:
+            baseline = json.load(fp)
+
+    regressions = compare(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump(results, fp, indent=4, sort_keys=True)
+
+    if regressions:
+        print('Regressions: %s' % ', '.join(regressions))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())